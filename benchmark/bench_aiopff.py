@@ -0,0 +1,41 @@
+'''
+Benchmark the concurrent reads of pypff.aiopff.
+Several readpff, read_metadata and read_time_range calls on one aiodatapff are awaited at the same time,
+and each result is checked against the metadata read by datapff, so the calls must not share any state.
+
+Usage:
+    python bench_aiopff.py fn [rounds]
+'''
+import sys
+import time
+import asyncio
+import numpy as np
+from pypff import io, aiopff
+
+async def bench(fn, rounds):
+    dpff = io.datapff(fn)
+    n = dpff.nframes()
+    ref = dpff._frametime(dpff.read_metadata())
+    apff = aiopff.open_pff(fn)
+    # (samples, skip) of the concurrent reads
+    reads = [(n//20, 0), (n//6, 3), (n//10, n//5), (n//3, n//10)]
+    t = time.perf_counter()
+    for i in range(rounds):
+        results = await asyncio.gather(*[apff.readpff(samples=s, skip=k, metadata=True) for s, k in reads])
+        mds = await asyncio.gather(*[apff.read_metadata(s, k) for s, k in reads])
+        for (s, k), (d, md), md2 in zip(reads, results, mds):
+            assert d.shape[0] == s, 'readpff: wrong number of frames: %d != %d'%(d.shape[0], s)
+            assert np.array_equal(dpff._frametime(md), ref[k:k+s]), 'readpff: wrong metadata, skip = %d'%(k)
+            assert np.array_equal(dpff._frametime(md2), ref[k:k+s]), 'read_metadata: wrong metadata, skip = %d'%(k)
+        t0 = [(ref[k], ref[min(k+s, n-1)]) for s, k in reads]
+        ranges = await asyncio.gather(*[apff.read_time_range(a/1e6, b/1e6) for a, b in t0])
+        for (a, b), (d, md) in zip(t0, ranges):
+            assert np.array_equal(dpff._frametime(md), ref[(ref >= a) & (ref < b)]), 'read_time_range: wrong metadata'
+    t = time.perf_counter() - t
+    print('%d rounds of %d concurrent reads: %.2f s, all of the results are correct'%(rounds, 3*len(reads), t))
+
+if __name__ == '__main__':
+    rounds = 20
+    if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+    asyncio.run(bench(sys.argv[1], rounds))
@@ -0,0 +1,65 @@
+'''
+Benchmark the hk.pff parsing of pypff.io.hkpff with each installed json backend,
+and with the boards and fields projection.
+The example hk.pff is repeated until the file reaches the given size.
+
+Usage:
+    python bench_hk.py [GB] [dir]
+'''
+import os
+import sys
+import time
+import tempfile
+from pypff import io
+
+HK_EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'example-data', 'hk.pff')
+
+def gen_hk(fn, size):
+    with open(HK_EXAMPLE, 'rb') as f:
+        hk = f.read()
+    block = hk * max(1, (64 << 20) // len(hk))
+    n = 0
+    with open(fn, 'wb') as f:
+        while n < size:
+            f.write(block)
+            n += len(block)
+    return n
+
+# boards and fields of the projection cases
+PROJECTIONS = [(['QUABO_*'], ['DET_TEMP', 'FPGA_TEMP']), (['GPSSUPP'], ['PPSOFFSET'])]
+
+def bench(fn, backend, columnar, boards=None, fields=None):
+    io.set_json_backend(backend)
+    t = time.perf_counter()
+    hk_info = io.hkpff(fn).readhk(columnar=columnar, boards=boards, fields=fields)
+    t = time.perf_counter() - t
+    records = sum(len(list(v.values())[0]) for v in hk_info.values())
+    return t, records
+
+if __name__ == '__main__':
+    size = 2.0
+    if len(sys.argv) > 1:
+        size = float(sys.argv[1])
+    d = None
+    if len(sys.argv) > 2:
+        d = sys.argv[2]
+    fd, fn = tempfile.mkstemp(suffix='.hk.pff', dir=d)
+    os.close(fd)
+    try:
+        n = gen_hk(fn, int(size * (1 << 30)))
+        print('hk.pff: %.2f GB'%(n / (1 << 30)))
+        for backend in ['json', 'orjson', 'simdjson']:
+            try:
+                io.set_json_backend(backend)
+            except ImportError:
+                print('%-8s not installed'%(backend))
+                continue
+            for columnar in [False, True]:
+                t, records = bench(fn, backend, columnar)
+                print('%-8s columnar=%-5s %9d records: %.2f s, %.1f MB/s'%(backend, columnar, records, t, n / t / (1 << 20)))
+            for boards, fields in PROJECTIONS:
+                t, records = bench(fn, backend, True, boards, fields)
+                print('%-8s %s %s %9d records: %.2f s, %.1f MB/s'%(backend, boards, fields, records, t, n / t / (1 << 20)))
+    finally:
+        os.remove(fn)
+        io.set_json_backend()
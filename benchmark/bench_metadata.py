@@ -0,0 +1,53 @@
+'''
+Benchmark the metadata decoding of pypff.io.datapff.
+It compares the vectorized ascii decoder (pypff.io._ascii2int) with the numpy string conversion,
+which was used by readpff before.
+
+Usage:
+    python bench_metadata.py [frames]
+'''
+import sys
+import time
+import numpy as np
+from pypff import io
+
+# metadata examples, which match io.loc_arr
+PH256_MD = b'{ "quabo_num": 0, "pkt_num":      32280, "pkt_tai":  398, "pkt_nsec": 723300414, "tv_sec": 1690934633, "tv_usec": 720082}\n'
+IMG_MD = (b'{\n' + b', \n'.join(
+    b'   "quabo_%d": { "pkt_num":      23855, "pkt_tai":  906, "pkt_nsec": 774507484, "tv_sec": 1691048805, "tv_usec": 778782}'%q
+    for q in range(4)) + b'\n}\n')
+
+def gen_metadata(md, md_size, frame_size, frames):
+    # put the metadata at the beginning of each frame, like a data pff file
+    buf = np.zeros((frames, frame_size), dtype=np.uint8)
+    buf[:, :len(md)] = np.frombuffer(md, dtype=np.uint8)
+    return buf[:, :md_size - 2]
+
+def flatten(loc):
+    locs = []
+    for k in loc.keys():
+        if isinstance(loc[k], dict):
+            locs += list(loc[k].values())
+        else:
+            locs.append(loc[k])
+    return locs
+
+def astype_decode(raw, locs):
+    return [raw[:, r0:r1].view(f'S{r1-r0}')[:, 0].astype(np.uint64) for r0, r1 in locs]
+
+def bench(name, raw, locs):
+    t = time.perf_counter()
+    ref = astype_decode(raw, locs)
+    t_ref = time.perf_counter() - t
+    t = time.perf_counter()
+    values = io._ascii2int(raw, locs)
+    t_new = time.perf_counter() - t
+    assert all(np.array_equal(ref[i], values[i]) for i in range(len(locs)))
+    print('%-6s %9d frames: astype %.3f s, _ascii2int %.3f s, speedup %.1fx'%(name, raw.shape[0], t_ref, t_new, t_ref/t_new))
+
+if __name__ == '__main__':
+    frames = 2000000
+    if len(sys.argv) > 1:
+        frames = int(sys.argv[1])
+    bench('ph256', gen_metadata(PH256_MD, 124, 124 + 256*2, frames), flatten(io.md_loc['ph256']))
+    bench('img16', gen_metadata(IMG_MD, 492, 492 + 1024*2, frames//4), flatten(io.md_loc['img16']))
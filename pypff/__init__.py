@@ -1,4 +1,7 @@
 from . import io
+from . import index
+from . import parallel
+from . import aiopff
 from . import pixelmap
 from .pixelmap_maroc2phys_bga import maroc2phys_bga
 from .pixelmap_maroc2phys_qfp import maroc2phys_qfp
@@ -0,0 +1,125 @@
+'''
+This module provides an asyncio API for reading data pff files.
+The blocking reads and the metadata decoding run in an executor, so they don't block the event loop.
+e.g.
+    async for data, metadata in open_pff(fn).chunks(1024):
+        ...
+'''
+import asyncio
+import copy
+import functools
+from .io import datapff
+
+def _call(dpff, name, *args, **kwargs):
+    # readpff and the other datapff methods keep their results in dpff.data, dpff.metadata and so on,
+    # so each call uses its own shallow copy of dpff, and the concurrent calls don't overwrite each other
+    return getattr(copy.copy(dpff), name)(*args, **kwargs)
+
+def _readchunk(dpff, samples, skip, metadata):
+    # it doesn't change the state of dpff, so it can run with the other reads at the same time
+    frames = dpff._readframes(samples, skip)
+    data = frames[:, dpff._md_size:].view(dpff.dtype)
+    md = {}
+    if metadata == True and frames.shape[0] != 0:
+        md = dpff._decode_metadata(frames[:, 0: dpff._md_size - 2])
+    return data, md
+
+class aiodatapff(object):
+    '''
+    Description:
+        The aiodatapff class is the asyncio version of datapff.
+    '''
+    def __init__(self, fn, executor=None):
+        '''
+        Description:
+            Create an aiodatapff object.
+        Inputs:
+            -- fn(str): pff file name.
+            -- executor(concurrent.futures.Executor): the executor for the blocking reads.
+                        If it's None, the default executor of the event loop is used.
+                        Default = None
+        '''
+        self.dpff = datapff(fn)
+        self.fn = fn
+        self.executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def readpff(self, samples=-1, skip=0, pixel=-1, metadata=False, mmap=False):
+        '''
+        Description:
+            Read data from the data pff file. See datapff.readpff.
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        return await self._run(_call, self.dpff, 'readpff', samples=samples, skip=skip, pixel=pixel,
+                               metadata=metadata, mmap=mmap)
+
+    async def read_metadata(self, samples=-1, skip=0):
+        '''
+        Description:
+            Read the metadata only. See datapff.read_metadata.
+        Output:
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        return await self._run(_call, self.dpff, 'read_metadata', samples, skip)
+
+    async def read_time_range(self, t0, t1, clock='unix', pixel=-1, metadata=True, mmap=False):
+        '''
+        Description:
+            Read the frames with t0 <= timestamp < t1. See datapff.read_time_range.
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        return await self._run(_call, self.dpff, 'read_time_range', t0, t1, clock=clock, pixel=pixel,
+                               metadata=metadata, mmap=mmap)
+
+    async def chunks(self, frames_per_chunk=1024, metadata=True):
+        '''
+        Description:
+            Read the data pff file chunk by chunk.
+            The next chunk is read in the executor while the caller is processing the current chunk.
+        Inputs:
+            -- frames_per_chunk(int): the number of frames in each chunk.
+                                      Default = 1024
+            -- metadata(bool): decode the metadata of each chunk.
+                               Default = True
+        Outputs:
+            -- data(np.array): data array of the chunk.
+            -- metadata(dict): a dict contains the metadata of the chunk.
+        '''
+        skip = 0
+        pending = asyncio.ensure_future(self._run(_readchunk, self.dpff, frames_per_chunk, skip, metadata))
+        try:
+            while True:
+                data, md = await pending
+                pending = None
+                n = data.shape[0]
+                if n == 0:
+                    break
+                skip += n
+                if n == frames_per_chunk:
+                    pending = asyncio.ensure_future(self._run(_readchunk, self.dpff, frames_per_chunk, skip, metadata))
+                yield data, md
+                if pending is None:
+                    break
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+def open_pff(fn, executor=None):
+    '''
+    Description:
+        Open a data pff file for asyncio.
+    Inputs:
+        -- fn(str): pff file name.
+        -- executor(concurrent.futures.Executor): the executor for the blocking reads.
+                    Default = None
+    Output:
+        -- dpff(aiodatapff): aiodatapff object.
+    '''
+    return aiodatapff(fn, executor)
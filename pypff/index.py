@@ -0,0 +1,451 @@
+'''
+This module builds the sidecar index (.pffidx) of a data pff file.
+The index is a directory next to the pff file, e.g. xxx.pff.pffidx, which contains
+the frame offsets, the metadata fields and the frame timestamps as .npy files.
+The .npy files can be memmapped, so the metadata doesn't need to be parsed again.
+The index is invalid once the size or the mtime of the pff file changes.
+
+hkindex is the sparse time index of hk.pff, which is in the same kind of directory, e.g. hk.pff.pffidx.
+It keeps the byte range and the Computer_UTC range of each block of records of each board,
+so a time range of a board can be read without parsing the whole file.
+It's extended, instead of rebuilt, when hk.pff grows.
+'''
+import os
+import re
+import json
+import numpy as np
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.pffidx'
+
+# dtype of the metadata fields in the index
+INDEX_DTYPES = {
+    'quabo_num' : np.uint8,
+    'pkt_num'   : np.uint32,
+    'pkt_tai'   : np.uint16,
+    'pkt_nsec'  : np.uint32,
+    'tv_sec'    : np.uint32,
+    'tv_usec'   : np.uint32
+}
+
+HK_INDEX_VERSION = 1
+# the number of records of a board in each block of the hk index
+HK_INDEX_STEP = 256
+# dtype of the blocks in the hk index
+HK_BLOCK_DTYPE = np.dtype([('start', np.int64), ('end', np.int64), ('tmin', np.float64), ('tmax', np.float64),
+                           ('n', np.int64)])
+# a hk record starts with the board name, e.g. {"QUABO_1016": {"Computer_UTC": "1690936804.7447193", ...
+_HK_RECORD = re.compile(rb'^\{"([^"]+)": *\{[^\n]*?"Computer_UTC": *"([^"]*)"', re.M)
+
+def index_dir(fn):
+    '''
+    Description:
+        Get the index directory of a data pff file.
+    Input:
+        -- fn(str): pff file name.
+    Output:
+        -- dir(str): index directory.
+    '''
+    return fn + INDEX_SUFFIX
+
+def _file_info(fn):
+    st = os.stat(fn)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def _hk_float(t):
+    try:
+        return float(t)
+    except ValueError:
+        return np.nan
+
+# dtype of a metadata field in the index
+#
+def _field_dtype(name, v, md_size):
+    if v.dtype == np.uint64:
+        return INDEX_DTYPES.get(name, np.uint64)
+    if v.dtype.kind == 'U':
+        # the metadata decoded by json may have str fields, which are stored as utf-8 bytes,
+        # and a field can't be longer than the metadata
+        return np.dtype('S%d'%(md_size - 2))
+    return v.dtype
+
+class pffindex(object):
+    '''
+    Description:
+        The pffindex class builds and loads the sidecar index of a data pff file.
+    '''
+    def __init__(self, dpff):
+        '''
+        Description:
+            Create a pffindex object for a datapff object.
+        Input:
+            -- dpff(datapff): the datapff object of the pff file.
+        '''
+        self.dpff = dpff
+        self.fn = dpff.fn
+        self.dir = index_dir(dpff.fn)
+        self._info = None
+        self._arrays = None
+
+    def info(self):
+        '''
+        Description:
+            Read the info of the index, which is in info.json.
+        Output:
+            -- info(dict): the info of the index. It's None if there is no index.
+        '''
+        try:
+            with open(os.path.join(self.dir, 'info.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def valid(self):
+        '''
+        Description:
+            Check if the index exists, and it's built from the current pff file.
+        Output:
+            -- valid(bool): True if the index can be used.
+        '''
+        info = self.info()
+        if info is None or info.get('version') != INDEX_VERSION:
+            return False
+        try:
+            finfo = _file_info(self.fn)
+        except OSError:
+            return False
+        return (info['size'] == finfo['size'] and info['mtime_ns'] == finfo['mtime_ns']
+                and info['datasize'] == self.dpff.datasize)
+
+    def build(self, frames_per_chunk=65536):
+        '''
+        Description:
+            Build the index by reading the metadata of the pff file in one pass.
+        Input:
+            -- frames_per_chunk(int): the number of frames decoded at once.
+                                      Default = 65536
+        Output:
+            -- info(dict): the info of the index.
+        '''
+        dpff = self.dpff
+        finfo = _file_info(self.fn)
+        n = finfo['size'] // dpff.datasize
+        os.makedirs(self.dir, exist_ok=True)
+        # remove the old info first, so the index is invalid until it's built
+        if os.path.exists(os.path.join(self.dir, 'info.json')):
+            os.remove(os.path.join(self.dir, 'info.json'))
+        arrays = {}
+        def _open(name, dtype, shape=(n,)):
+            arrays[name] = np.lib.format.open_memmap(os.path.join(self.dir, name + '.npy'),
+                                                     mode='w+', dtype=dtype, shape=shape)
+            return arrays[name]
+        _open('offset', np.int64)[:] = np.arange(n, dtype=np.int64) * dpff.datasize
+        _open('t_unix', np.int64)
+        _open('t_wr', np.int64)
+        fields = []
+        for skip in range(0, n, frames_per_chunk):
+            samples = min(frames_per_chunk, n - skip)
+            md = dpff.read_metadata(samples, skip)
+            if skip == 0:
+                for k, v in md.items():
+                    if isinstance(v, dict):
+                        fields += [(k, kk) for kk in v.keys()]
+                    else:
+                        fields.append((k,))
+                for path in fields:
+                    v = md
+                    for k in path:
+                        v = v[k]
+                    _open('.'.join(path), _field_dtype(path[-1], v, dpff._md_size))
+            for path in fields:
+                v = md
+                for k in path:
+                    v = v[k]
+                if v.dtype.kind == 'U':
+                    v = np.char.encode(v, 'utf-8')
+                arrays['.'.join(path)][skip:skip+samples] = v
+            arrays['t_unix'][skip:skip+samples] = dpff._frametime(md, 'unix')
+            arrays['t_wr'][skip:skip+samples] = dpff._frametime(md, 'wr')
+        for v in arrays.values():
+            v.flush()
+        info = {
+            'version': INDEX_VERSION,
+            'dp': dpff.dp,
+            'datasize': dpff.datasize,
+            'nframes': n,
+            'fields': ['.'.join(path) for path in fields],
+            'size': finfo['size'],
+            'mtime_ns': finfo['mtime_ns']
+        }
+        with open(os.path.join(self.dir, 'info.json'), 'w') as f:
+            json.dump(info, f)
+        self._info = None
+        self._arrays = None
+        return info
+
+    def load(self):
+        '''
+        Description:
+            Load the index as memmapped arrays.
+        Output:
+            -- arrays(dict): 'offset', 't_unix', 't_wr' and the metadata fields, e.g. 'quabo_0.tv_sec'.
+                             It's None if the index is invalid.
+        '''
+        if not self.valid():
+            return None
+        info = self.info()
+        if self._info != info:
+            self._arrays = {}
+            for name in ['offset', 't_unix', 't_wr'] + info['fields']:
+                self._arrays[name] = np.load(os.path.join(self.dir, name + '.npy'), mmap_mode='r')
+            self._info = info
+        return self._arrays
+
+    def metadata(self, samples=-1, skip=0):
+        '''
+        Description:
+            Get the metadata from the index, in the same format as datapff.read_metadata.
+        Inputs:
+            -- samples(int): The sample number to be read out.
+                             If it's -1, all of the metadata will be read out.
+                             Default = -1
+            -- skip(int): Skip the number of samples.
+                          Default = 0
+        Output:
+            -- metadata(dict): a dict contains the metadata from each sample.
+                               It's None if the index is invalid.
+        '''
+        arrays = self.load()
+        if arrays is None:
+            return None
+        end = None
+        if samples != -1:
+            end = skip + samples
+        metadata = {}
+        for name in self._info['fields']:
+            path = name.split('.')
+            d = metadata
+            for k in path[:-1]:
+                d = d.setdefault(k, {})
+            v = arrays[name][skip:end]
+            if v.dtype.kind == 'S':
+                d[path[-1]] = np.char.decode(v, 'utf-8')
+            elif v.dtype.kind == 'u':
+                d[path[-1]] = v.astype(np.uint64)
+            else:
+                d[path[-1]] = np.array(v)
+        return metadata
+
+def build(fn):
+    '''
+    Description:
+        Build the index of a data pff file.
+    Input:
+        -- fn(str): pff file name.
+    Output:
+        -- info(dict): the info of the index.
+    '''
+    from .io import datapff
+    return pffindex(datapff(fn)).build()
+
+
+class hkindex(object):
+    '''
+    Description:
+        The hkindex class builds and loads the sparse time index of hk.pff.
+    '''
+    def __init__(self, fn):
+        '''
+        Description:
+            Create a hkindex object for a hk.pff file.
+        Input:
+            -- fn(str): file name of a hk.pff.
+        '''
+        self.fn = fn
+        self.dir = index_dir(fn)
+        # the index in memory, which is used if the sidecar can't be written, e.g. on a read-only disk
+        self._info = None
+        self._blocks = None
+
+    def info(self):
+        '''
+        Description:
+            Read the info of the index, which is in info.json.
+        Output:
+            -- info(dict): the info of the index. It's None if there is no index.
+        '''
+        try:
+            with open(os.path.join(self.dir, 'info.json'), 'r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if info.get('version') != HK_INDEX_VERSION or info.get('kind') != 'hk':
+            return None
+        return info
+
+    def valid(self):
+        '''
+        Description:
+            Check if the index exists, and it's built from the current hk.pff.
+        Output:
+            -- valid(bool): True if the index can be used without updating it.
+        '''
+        info = self.info()
+        if info is None:
+            return False
+        try:
+            finfo = _file_info(self.fn)
+        except OSError:
+            return False
+        return info['size'] == finfo['size'] and info['mtime_ns'] == finfo['mtime_ns']
+
+    def load(self):
+        '''
+        Description:
+            Load the blocks of each board.
+        Output:
+            -- blocks(dict): a structured array of HK_BLOCK_DTYPE for each board.
+                             It's None if there is no index.
+        '''
+        info = self.info()
+        if info is None:
+            return None
+        return dict((board, np.load(os.path.join(self.dir, name))) for board, name in info['boards'].items())
+
+    def _scan(self, offset, size, step, chunksize):
+        # scan the complete lines in [offset, size), and return the blocks of each board
+        blocks = {}
+        with open(self.fn, 'rb') as f:
+            f.seek(offset)
+            carry = b''
+            pos = offset
+            while pos + len(carry) < size:
+                buf = f.read(min(chunksize, size - pos - len(carry)))
+                if len(buf) == 0:
+                    break
+                buf = carry + buf
+                end = buf.rfind(b'\n') + 1
+                carry = buf[end:]
+                starts = []
+                keys = []
+                times = []
+                for m in _HK_RECORD.finditer(buf, 0, end):
+                    starts.append(m.start())
+                    keys.append(m.group(1))
+                    times.append(m.group(2))
+                if len(starts) != 0:
+                    starts = np.array(starts, dtype=np.int64)
+                    try:
+                        times = np.array(times).astype(np.float64)
+                    except ValueError:
+                        times = np.array([_hk_float(t) for t in times])
+                    keys, inv = np.unique(np.array(keys), return_inverse=True)
+                    for j, key in enumerate(keys):
+                        idx = np.nonzero(inv == j)[0]
+                        for b in range(0, len(idx), step):
+                            sel = idx[b:b+step]
+                            t = times[sel]
+                            t = t[~np.isnan(t)]
+                            if len(t) == 0:
+                                # the block is always read
+                                t = np.array([-np.inf, np.inf])
+                            last = starts[sel[-1]]
+                            block = (pos + starts[sel[0]], pos + buf.find(b'\n', last) + 1, t.min(), t.max(), len(sel))
+                            blocks.setdefault(key.decode('utf-8'), []).append(block)
+                pos += end
+        return dict((k, np.array(v, dtype=HK_BLOCK_DTYPE)) for k, v in blocks.items()), pos
+
+    def update(self, step=HK_INDEX_STEP, chunksize=64<<20):
+        '''
+        Description:
+            Build the index, or extend it with the lines appended since it was updated.
+            The partial line at the end of the file is indexed next time.
+            If the sidecar can't be written, the index is only kept in memory.
+        Inputs:
+            -- step(int): the number of records of a board in each block.
+                          Default = HK_INDEX_STEP
+            -- chunksize(int): the number of bytes read at once.
+                               Default = 64 MB
+        Output:
+            -- info(dict): the info of the index.
+        '''
+        info = self._info
+        if info is None:
+            info = self.info()
+        finfo = _file_info(self.fn)
+        if info is not None and info['size'] == finfo['size'] and info['mtime_ns'] == finfo['mtime_ns']:
+            if self._info is None:
+                self._info = info
+                self._blocks = self.load()
+            return info
+        blocks = {}
+        offset = 0
+        if info is not None and info['step'] == step and info['offset'] <= finfo['size']:
+            # hk.pff is only appended, so the old blocks are kept
+            blocks = self._blocks
+            if blocks is None:
+                blocks = self.load()
+            offset = info['offset']
+        new, offset = self._scan(offset, finfo['size'], step, chunksize)
+        for k, v in new.items():
+            if k in blocks:
+                blocks[k] = np.concatenate([blocks[k], v])
+            else:
+                blocks[k] = v
+        boards = {}
+        for i, k in enumerate(sorted(blocks.keys())):
+            boards[k] = 'board_%d.npy'%(i)
+        info = {
+            'version': HK_INDEX_VERSION,
+            'kind': 'hk',
+            'step': step,
+            'offset': offset,
+            'boards': boards,
+            'size': finfo['size'],
+            'mtime_ns': finfo['mtime_ns']
+        }
+        self._info = info
+        self._blocks = blocks
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            if os.path.exists(os.path.join(self.dir, 'info.json')):
+                os.remove(os.path.join(self.dir, 'info.json'))
+            for k, v in blocks.items():
+                np.save(os.path.join(self.dir, boards[k]), v)
+            with open(os.path.join(self.dir, 'info.json'), 'w') as f:
+                json.dump(info, f)
+        except OSError:
+            # e.g. a read-only archive, so the index is only kept in memory
+            pass
+        return info
+
+    def ranges(self, board, t0=None, t1=None):
+        '''
+        Description:
+            Get the byte ranges of the blocks of a board, which may have records with t0 <= Computer_UTC < t1.
+            The index is updated first.
+        Inputs:
+            -- board(str): the board name, e.g. 'QUABO_1016'.
+            -- t0(float): unix time in seconds. If it's None, there is no lower bound.
+                          Default = None
+            -- t1(float): unix time in seconds. If it's None, there is no upper bound.
+                          Default = None
+        Output:
+            -- ranges(list): [(start, end)] in the file, which are sorted and merged.
+        '''
+        self.update()
+        blocks = self._blocks.get(board)
+        if blocks is None:
+            return []
+        sel = np.ones(len(blocks), dtype=bool)
+        if t0 is not None:
+            sel &= blocks['tmax'] >= t0
+        if t1 is not None:
+            sel &= blocks['tmin'] < t1
+        ranges = []
+        for start, end in sorted(zip(blocks['start'][sel].tolist(), blocks['end'][sel].tolist())):
+            if len(ranges) != 0 and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return [tuple(r) for r in ranges]
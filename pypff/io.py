@@ -1,16 +1,74 @@
 '''
 This module provides methods to reading pff data file, including img16, img8, ph256, ph1024 and hk.pff
 '''
+import os
+import re
 import json
 import datetime
+import time
+import heapq
+import queue
+import threading
+import fnmatch
+from collections import OrderedDict
+from collections.abc import Mapping
 import numpy as np
 from glob import glob
 from . import pixelmap
+from .index import pffindex, hkindex, INDEX_DTYPES
+
+# the json backends, which parse bytes directly, in the order they're tried
+def _simdjson_loads():
+    import simdjson
+    return simdjson.loads
+
+def _orjson_loads():
+    import orjson
+    return orjson.loads
+
+def _stdlib_loads():
+    return json.loads
+
+_JSON_BACKENDS = OrderedDict([('orjson', _orjson_loads), ('simdjson', _simdjson_loads), ('json', _stdlib_loads)])
+
+def set_json_backend(name=None):
+    '''
+    Description:
+        Set the json backend for parsing hk.pff and the metadata.
+        orjson and simdjson are much faster than the json module, and they are used if they are installed.
+    Input:
+        -- name(str): 'orjson', 'simdjson' or 'json'.
+                      If it's None, the first installed one is used.
+                      Default = None
+    Output:
+        -- name(str): the name of the json backend.
+    '''
+    global JSON_BACKEND, _json_loads
+    if name is not None and name not in _JSON_BACKENDS:
+        raise Exception('Json backend is not supported: %s'%(name))
+    for k, backend in _JSON_BACKENDS.items():
+        if name is not None and k != name:
+            continue
+        try:
+            _json_loads = backend()
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        JSON_BACKEND = k
+        return k
+
+JSON_BACKEND = None
+_json_loads = json.loads
+set_json_backend()
 
 MOBO_DIM = 16
 QUABO_DIM = 32
+# pkt_num is a 16-bit counter in the quabo packets
+PKT_NUM_MOD = 2**16
 
-# The metadata loc in the data is hard-coded here.
+# The default metadata loc, which is used when the metadata can't be read from the file.
+# The metadata loc of each file is derived from its first frame by datapff._detect_layout.
 loc_arr = np.zeros(2, dtype=object)
 # metadata loc for ph256
 # metadata example
@@ -88,6 +146,716 @@ def _gen_dict_template(d):
         template[k] = []
     return template
 
+# the value of a missing hk field, by the column type
+_HK_FILL = {np.int64: '0', np.float64: 'nan', np.str_: ''}
+# the number of hk values converted at once
+_HK_BATCH = 4096
+
+# get the column type of a hk field from its first value
+#
+def _hk_type(k, v):
+    # Computer_UTC is the unix time in seconds
+    if k == 'Computer_UTC':
+        return np.float64
+    for t, dtype in [(int, np.int64), (float, np.float64)]:
+        try:
+            t(v)
+            return dtype
+        except (ValueError, TypeError):
+            pass
+    return np.str_
+
+class _hkcolumn(object):
+    '''
+    Description:
+        A growable typed array of a hk field.
+        The values are kept in a batch, and the batch is converted by numpy at once.
+        If a value can't be converted, the column is promoted from int to float if the value is a number, or to str.
+    '''
+    def __init__(self, dtype, n=0):
+        self.dtype = dtype
+        self.fill = _HK_FILL[dtype]
+        self.data = np.zeros(max(n, 1024), dtype=dtype)
+        self.n = 0
+        # the field is new, so the previous records don't have it
+        self.batch = [self.fill] * n
+
+    def _promote(self, values):
+        if self.dtype == np.int64:
+            try:
+                values.astype(np.float64)
+                self.dtype = np.float64
+                self.data = self.data.astype(np.float64)
+                return
+            except ValueError:
+                pass
+        # an int column is converted to str directly, so "0" is still '0' instead of '0.0'
+        self.dtype = np.str_
+        self.data = self.data.astype(np.str_)
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        # the values are converted from str, so a float is not truncated to an int
+        values = np.array(self.batch, dtype=np.str_)
+        while True:
+            try:
+                values = values.astype(self.dtype)
+                break
+            except ValueError:
+                self._promote(values)
+        m = len(values)
+        if self.n + m > len(self.data) or values.dtype.itemsize > self.data.dtype.itemsize:
+            data = np.zeros(max(2*len(self.data), self.n + m), dtype=np.promote_types(self.data.dtype, values.dtype))
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+        self.data[self.n:self.n+m] = values
+        self.n += m
+        # the batch is cleared in place, because _hkboard keeps its append method
+        self.batch.clear()
+
+    def array(self, copy=True):
+        self.flush()
+        if copy == False:
+            return self.data[:self.n]
+        return self.data[:self.n].copy()
+
+class _hkboard(object):
+    '''
+    Description:
+        The columns of a hk board.
+        The records of a board usually have the same fields in the same order, so the columns are
+        looked up only when the fields change.
+    '''
+    def __init__(self):
+        self.columns = {}
+        self.keys = None
+        self.cols = []
+        self.appends = []
+        self.missing = []
+        self.n = 0
+
+    def _update(self, record):
+        self.keys = tuple(record.keys())
+        self.cols = []
+        for k, v in record.items():
+            # chagne TEMP1 to DET_TEMP, and change TEMP1 to FPGA_TEMP
+            if k == 'TEMP1':
+                k = 'DET_TEMP'
+            if k == 'TEMP2':
+                k = 'FPGA_TEMP'
+            if not k in self.columns:
+                self.columns[k] = _hkcolumn(_hk_type(k, v), self.n)
+            self.cols.append(self.columns[k])
+        self.appends = [col.batch.append for col in self.cols]
+        self.missing = [col for col in self.columns.values() if not any(col is c for c in self.cols)]
+
+    def append(self, record):
+        if tuple(record.keys()) != self.keys:
+            self._update(record)
+        for append, v in zip(self.appends, record.values()):
+            append(v)
+        # fill the fields which are not in this record
+        for col in self.missing:
+            col.batch.append(col.fill)
+        self.n += 1
+        if self.n % _HK_BATCH == 0:
+            self.flush()
+
+    def flush(self):
+        for col in self.columns.values():
+            col.flush()
+
+    def arrays(self, copy=True):
+        return dict((k, col.array(copy)) for k, col in self.columns.items())
+
+# parse the hk lines into the columns of each board
+#
+def _append_hk(lines, boards, match=None, fields=None):
+    for hk_str in lines:
+        # skip the empty lines without calling the json parser
+        if len(hk_str) == 0 or hk_str.isspace():
+            continue
+        if match is not None and not match(hk_str):
+            continue
+        try:
+            hk = _json_loads(hk_str)
+        except:
+            continue
+        key, = hk.keys()
+        if not key in boards:
+            boards[key] = _hkboard()
+        boards[key].append(_hk_project(hk[key], fields))
+
+# get the function which checks the board name of a hk line, before parsing it
+#
+def _hk_match(boards):
+    '''
+    Description:
+        A hk line starts with the board name, e.g. {"QUABO_1016": {...}, so the board name is checked
+        by the bytes at the beginning of the line.
+    Input:
+        -- boards(list): board names, or patterns such as 'QUABO_*'.
+    Output:
+        -- match(function): match(line) returns True if the line is from one of the boards.
+                            It's None if boards is None.
+    '''
+    if boards is None:
+        return None
+    if isinstance(boards, str):
+        boards = [boards]
+    prefixes = tuple(('{"%s"'%(b)).encode('utf-8') for b in boards if not any(c in b for c in '*?['))
+    patterns = [b for b in boards if any(c in b for c in '*?[')]
+    cache = {}
+    def match(line):
+        if line.startswith(prefixes):
+            return True
+        if len(patterns) == 0:
+            return False
+        key = line[2:line.find(b'"', 2)]
+        if not key in cache:
+            name = key.decode('utf-8', 'replace')
+            cache[key] = any(fnmatch.fnmatchcase(name, p) for p in patterns)
+        return cache[key]
+    return match
+
+# get the fields in hk.pff, which are requested by the user
+#
+def _hk_fields(fields):
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = [fields]
+    keys = []
+    for k in fields:
+        # DET_TEMP and FPGA_TEMP are TEMP1 and TEMP2 in hk.pff
+        k = {'DET_TEMP': 'TEMP1', 'FPGA_TEMP': 'TEMP2'}.get(k, k)
+        if not k in keys:
+            keys.append(k)
+    return keys
+
+# get the requested fields of a hk record
+#
+def _hk_project(record, fields):
+    if fields is None:
+        return record
+    return dict((k, record[k]) for k in fields if k in record)
+
+# The metadata size is derived from the data file, and it should be less than _MAX_MD_SIZE
+_MAX_MD_SIZE = 4096
+# header signature: the metadata with the digits replaced by spaces
+_SIGNATURE_TABLE = bytes.maketrans(b'0123456789', b' '*10)
+# regex for the metadata: an int field, the beginning of a sub-dict or the end of a sub-dict
+_MD_TOKEN = re.compile(rb'"(\w+)":( *\d+)|"(\w+)": *\{|\}')
+# metadata size and loc derived by _parse_layout, keyed by (dp, signature)
+_layout_cache = {}
+
+# derive the metadata size and loc from the metadata of a frame
+#
+def _parse_layout(md):
+    '''
+    Description:
+        Derive the metadata size and loc from the metadata of a frame.
+    Input:
+        -- md(bytes): bytes from the beginning of a frame, including the '*' at the end of the metadata.
+    Output:
+        -- md_size(int): metadata size, including the '*'.
+        -- md_loc(dict): metadata loc, which is in the same format as loc_arr.
+        It returns None if there is any field which is not an int.
+    '''
+    star = md.find(b'*')
+    try:
+        md_json = _json_loads(md[:star])
+    except ValueError:
+        return None
+    loc = {}
+    stack = [loc]
+    for m in _MD_TOKEN.finditer(md[:star]):
+        if m.group(1) is not None:
+            stack[-1][m.group(1).decode()] = [m.start(2), m.end(2)]
+        elif m.group(3) is not None:
+            stack[-1][m.group(3).decode()] = {}
+            stack.append(stack[-1][m.group(3).decode()])
+        elif len(stack) > 1:
+            stack.pop()
+    # every field in the metadata should be found
+    def _same_keys(d, l):
+        if set(d.keys()) != set(l.keys()):
+            return False
+        for k, v in d.items():
+            if isinstance(v, dict):
+                if not isinstance(l[k], dict) or not _same_keys(v, l[k]):
+                    return False
+            elif isinstance(l[k], dict) or not isinstance(v, int):
+                return False
+        return True
+    if not isinstance(md_json, dict) or not _same_keys(md_json, loc):
+        return None
+    return star + 1, loc
+
+# get a list of (keys, [r0, r1]) from the metadata loc
+#
+def _flatten_loc(loc, path=()):
+    fields = []
+    for k, v in loc.items():
+        if isinstance(v, dict):
+            fields += _flatten_loc(v, path + (k,))
+        else:
+            fields.append((path + (k,), v))
+    return fields
+
+# numpy structured dtype of a frame
+#
+def frame_dtype(dp, bpp=2, loc=None, md_size=None):
+    '''
+    Description:
+        Get the numpy structured dtype of a frame in the data pff file.
+        The metadata fields are fixed-width bytes under 'hdr', and the data is under 'pixels'.
+        e.g. frames['pixels'], frames['hdr']['pkt_num'] or frames['hdr']['quabo_0']['tv_sec'].
+    Inputs:
+        -- dp(str): data product, including ph256, ph1024, img16 and img8.
+        -- bpp(int): bytes per pixel.
+                     Default = 2
+        -- loc(dict): metadata loc. If it's None, the default loc in md_loc is used.
+                      If it's {}, e.g. the metadata is decoded by json, 'hdr' is the whole metadata as bytes.
+                      Default = None
+        -- md_size(int): metadata size. If it's None, the default size is used.
+                         Default = None
+    Output:
+        -- dtype(np.dtype): structured dtype of a frame.
+    '''
+    if dp not in md_loc:
+        raise Exception('Data type is not supproted: %s'%(dp))
+    if loc is None:
+        loc = md_loc[dp]
+    if dp == 'ph256':
+        pixels = 256
+    else:
+        pixels = 1024
+    if md_size is None:
+        if dp == 'ph256':
+            md_size = 124
+        else:
+            md_size = 492
+    if dp == 'ph256' or dp == 'ph1024':
+        dtype = np.int16
+    elif dp == 'img16':
+        dtype = np.uint16
+    else:
+        dtype = np.uint8
+    def _hdr_dtype(loc, base):
+        names = []
+        formats = []
+        offsets = []
+        end = base
+        for k, v in loc.items():
+            if isinstance(v, dict):
+                r0 = min(l[0] for p, l in _flatten_loc(v))
+                sub = _hdr_dtype(v, r0)
+                names.append(k)
+                formats.append(sub)
+                offsets.append(r0 - base)
+                end = max(end, r0 + sub.itemsize)
+            else:
+                names.append(k)
+                formats.append('S%d'%(v[1] - v[0]))
+                offsets.append(v[0] - base)
+                end = max(end, v[1])
+        return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': end - base})
+    if len(loc) == 0:
+        # the fields aren't at fixed offsets, so the metadata without the '* ' is kept as one field
+        hdr = np.dtype('S%d'%(md_size - 2))
+    else:
+        hdr = _hdr_dtype(loc, 0)
+    return np.dtype({'names': ['hdr', 'pixels'],
+                     'formats': [hdr, (np.dtype(dtype), (pixels,))],
+                     'offsets': [0, md_size],
+                     'itemsize': md_size + pixels * bpp})
+
+# The metadata is decoded in chunks of frames, so the temporary arrays stay in the cache
+_DECODE_FRAMES = 16384
+
+# convert the fixed-width ascii integers in the metadata to uint64
+#
+def _ascii2int(raw, locs, out=None):
+    '''
+    Description:
+        Convert the fixed-width ascii integers in the raw metadata to uint64.
+        The field ending at r1 is loaded as two uint64 words from the 16 bytes before r1.
+        The digits are masked with 0x0F, so the padding spaces become 0, and the 8 digits
+        in each word are combined by 3 multiply-shift steps (SWAR).
+        The fields which can't be loaded in this way fall back to the numpy string conversion.
+    Inputs:
+        -- raw(np.array): uint8 array with shape (frames, bytes).
+        -- locs(list): [r0, r1] of each field.
+        -- out(list): the output array of each field, which has at least `frames` elements.
+                      If it's None, a new array is created.
+    Output:
+        -- values(np.array or list): uint64 array with shape (fields, frames), or out.
+    '''
+    n, width = raw.shape
+    if out is None:
+        values = np.zeros((len(locs), n), dtype=np.uint64)
+    else:
+        values = out
+    fast = [i for i, (r0, r1) in enumerate(locs) if r1 >= 16 and r1 - r0 <= 16]
+    for i, (r0, r1) in enumerate(locs):
+        if i not in fast:
+            values[i][:n] = raw[:, r0:r1].view(f'S{r1-r0}')[:, 0].astype(np.uint64)
+    if len(fast) == 0 or n == 0:
+        return values
+    offs = []
+    mask = []
+    for i in fast:
+        r0, r1 = locs[i]
+        offs += [r1 - 16, r1 - 8]
+        m = np.zeros(16, dtype=np.uint8)
+        m[16 - (r1 - r0):] = 0x0F
+        mask.append(m.view('<u8'))
+    offs = np.array(offs)
+    mask = np.concatenate(mask)
+    # an overlapping view of the uint64 word starting at each byte
+    words = np.lib.stride_tricks.as_strided(raw, shape=(n, width - 7, 8),
+                                            strides=(raw.strides[0], raw.strides[1], raw.strides[1]),
+                                            writeable=False)
+    words = words.view('<u8')[:, :, 0]
+    for c in range(0, n, _DECODE_FRAMES):
+        e = min(c + _DECODE_FRAMES, n)
+        x = words[c:e, offs]
+        x &= mask
+        x *= np.uint64(2561)
+        x >>= np.uint64(8)
+        x &= np.uint64(0x00FF00FF00FF00FF)
+        x *= np.uint64(6553601)
+        x >>= np.uint64(16)
+        x &= np.uint64(0x0000FFFF0000FFFF)
+        x *= np.uint64(42949672960001)
+        x >>= np.uint64(32)
+        v = x[:, 0::2] * np.uint64(10**8)
+        v += x[:, 1::2]
+        for j, i in enumerate(fast):
+            values[i][c:e] = v[:, j]
+    return values
+
+# parse the data pff file name
+#
+def _parse_fn(fn):
+    '''
+    Description:
+        Get the start time, data product, bpp, module and seqno from the data pff file name,
+        e.g. start_2025-08-02T05:31:36Z.dp_ph256.bpp_2.module_254.seqno_0.pff
+    Input:
+        -- fn(str): pff file name.
+    Output:
+        -- info(dict): 'startdt', 'dp', 'bpp', 'module' and 'seqno'.
+    '''
+    fn_str = fn.split('/')[-1]
+    info = fn_str.split('.')
+    stringIndex = 0
+    if len(info[0]) != 0:
+        stringIndex = 0
+    else:
+        stringIndex = 1
+    startdt_str = info[stringIndex].split('_')[1]
+    stringIndex += 1
+    # It looks like we have two formats of file name
+    try:
+        startdt = datetime.datetime.strptime(startdt_str, '%Y-%m-%dT%H:%M:%SZ')
+    except:
+        # macos
+        startdt = datetime.datetime.strptime(startdt_str, '%Y-%m-%dT%H-%M-%SZ')
+    dp = info[stringIndex].split('_')[1]
+    stringIndex += 1
+    bpp = int(info[stringIndex].split('_')[1])
+    stringIndex += 1
+    module = int(info[stringIndex].split('_')[1])
+    stringIndex += 1
+    seqno = int(info[stringIndex].split('_')[1])
+    return {'startdt': startdt, 'dp': dp, 'bpp': bpp, 'module': module, 'seqno': seqno}
+
+# the files in a series have the same start time, dp, bpp and module
+#
+def _series_key(info):
+    return (info['startdt'], info['dp'], info['bpp'], info['module'])
+
+# concatenate the metadata dicts of several reads
+#
+def _concat_metadata(mds):
+    mds = [md for md in mds if len(md) != 0]
+    if len(mds) == 0:
+        return {}
+    if isinstance(mds[0], np.ndarray):
+        return np.concatenate(mds)
+    if all(isinstance(md, lazymetadata) and md._loc == mds[0]._loc and md._out is None for md in mds):
+        return lazymetadata(np.concatenate([md._raw for md in mds]), mds[0]._loc)
+    metadata = {}
+    for k, v in mds[0].items():
+        if isinstance(v, Mapping):
+            metadata[k] = _concat_metadata([md[k] for md in mds])
+        else:
+            metadata[k] = np.concatenate([md[k] for md in mds])
+    return metadata
+
+# get the frames in a slice from the metadata dict
+#
+def _slice_metadata(md, s):
+    if isinstance(md, lazymetadata) and md._out is None:
+        return lazymetadata(md._raw[s], md._loc)
+    metadata = {}
+    for k, v in md.items():
+        if isinstance(v, Mapping):
+            metadata[k] = _slice_metadata(v, s)
+        else:
+            metadata[k] = v[s]
+    return metadata
+
+# read a file chunk by chunk
+#
+def _read_chunks(f, chunksize, reuse=False):
+    '''
+    Description:
+        Read a file chunk by chunk.
+        If reuse is True, every chunk is read into the same buffer.
+    Output:
+        -- buf(bytes or bytearray), n(int): the chunk and the number of bytes in it.
+    '''
+    if reuse == True:
+        buf = bytearray(chunksize)
+    while True:
+        if reuse == True:
+            n = f.readinto(buf)
+        else:
+            buf = f.read(chunksize)
+            n = len(buf)
+        yield buf, n
+        if n < chunksize:
+            break
+
+
+class _prefetcher(object):
+    '''
+    Description:
+        Read a file chunk by chunk in a background thread.
+        The chunks are read into a ring of prefetch + 2 preallocated buffers: one is being processed,
+        at most prefetch are in the queue, and one is being read. The thread waits when the queue is full.
+    '''
+    def __init__(self, f, chunksize, prefetch=2):
+        self.f = f
+        self.ring = [bytearray(chunksize) for i in range(prefetch + 2)]
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        k = 0
+        try:
+            while not self.stop.is_set():
+                buf = self.ring[k % len(self.ring)]
+                n = self.f.readinto(buf)
+                self._put((buf, n))
+                if n < len(buf):
+                    break
+                k += 1
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            if item[1] < len(item[0]):
+                break
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+# get a field from the metadata dict by its keys
+#
+def _get_field(md, path):
+    for k in path:
+        md = md[k]
+    return md
+
+# copy the metadata into the output arrays
+#
+def _copy_metadata(md, out=None):
+    if out is None:
+        return md
+    metadata = {}
+    for k, v in md.items():
+        if isinstance(v, Mapping):
+            metadata[k] = _copy_metadata(v, out[k])
+        else:
+            np.copyto(out[k][:len(v)], v)
+            metadata[k] = out[k][:len(v)]
+    return metadata
+
+class lazymetadata(Mapping):
+    '''
+    Description:
+        The lazymetadata class is a read-only dict of the metadata, which keeps the raw metadata bytes
+        and decodes a field only when it's first accessed, e.g. md['tv_sec'] or md['quabo_0']['pkt_num'].
+        The decoded fields are cached.
+    '''
+    def __init__(self, metadataraw, loc, out=None):
+        '''
+        Description:
+            Create a lazymetadata object.
+        Inputs:
+            -- metadataraw(np.array): uint8 array with shape (frames, _md_size - 2).
+                                      It can be a view of the np.memmap of the file.
+            -- loc(dict): the metadata location, e.g. md_loc['ph256'].
+            -- out(dict): the output arrays in the same format as the metadata.
+                          Default = None
+        '''
+        self._raw = metadataraw
+        self._loc = loc
+        self._out = out
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            loc = self._loc[key]
+            out = None
+            if self._out is not None:
+                out = self._out[key]
+            if isinstance(loc, dict):
+                self._cache[key] = lazymetadata(self._raw, loc, out)
+            else:
+                n = self._raw.shape[0]
+                if out is not None:
+                    out = [out]
+                self._cache[key] = _ascii2int(self._raw, [loc], out)[0][:n]
+        return self._cache[key]
+
+    def __iter__(self):
+        return iter(self._loc)
+
+    def __len__(self):
+        return len(self._loc)
+
+    def __repr__(self):
+        return 'lazymetadata(%s, frames=%d)'%(list(self._loc.keys()), self._raw.shape[0])
+
+    def todict(self):
+        '''
+        Description:
+            Decode all of the fields.
+        Output:
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        return dict((k, v.todict() if isinstance(v, lazymetadata) else v) for k, v in self.items())
+
+# the columns of the metadata table
+#
+def _table_fields(loc):
+    quabos = []
+    names = []
+    for path, v in _flatten_loc(loc):
+        if len(path) > 1 and path[0] not in quabos:
+            quabos.append(path[0])
+        if path[-1] not in names:
+            names.append(path[-1])
+    return quabos, names
+
+# create an empty metadata table
+#
+def _empty_table(loc, n, dtypes=None):
+    quabos, names = _table_fields(loc)
+    if dtypes is None:
+        dtypes = {}
+    dtype = np.dtype([(name, dtypes.get(name, INDEX_DTYPES.get(name, np.uint64))) for name in names])
+    if len(quabos) == 0:
+        return np.zeros(n, dtype=dtype)
+    return np.zeros((n, len(quabos)), dtype=dtype)
+
+# get the column of a metadata field in the table
+#
+def _table_column(table, path):
+    if len(path) == 1:
+        return table[path[0]]
+    return table[:, int(path[0].split('_')[-1])][path[-1]]
+
+# check the preallocated metadata table against the table to be decoded
+#
+def _check_table(out, table, n):
+    if out.dtype != table.dtype or out.shape[1:] != table.shape[1:] or out.shape[0] < n:
+        raise Exception('The output of the metadata table should have dtype %s and shape (>=%d,)+%s: %s %s'
+                        %(table.dtype, n, table.shape[1:], out.dtype, out.shape))
+
+# copy the metadata table into the preallocated table
+#
+def _copy_table(table, out=None):
+    if out is None:
+        return table
+    _check_table(out, table, table.shape[0])
+    out[:table.shape[0]] = table
+    return out[:table.shape[0]]
+
+# convert the metadata dict to a compact table
+#
+def metadata_table(metadata):
+    '''
+    Description:
+        Convert the metadata dict to a compact numpy structured array.
+        The shape is (frames,) for ph256, and (frames, quabos) for ph1024, img16 and img8,
+        so the quabos can be compared by one expression, e.g. table['tv_sec'].max(axis=1).
+        Each field uses the smallest dtype, e.g. uint8 for quabo_num and uint32 for pkt_num.
+    Input:
+        -- metadata(dict): a dict contains the metadata from each sample.
+    Output:
+        -- table(np.array): structured array of the metadata.
+    '''
+    loc = {}
+    n = 0
+    for k, v in metadata.items():
+        if isinstance(v, Mapping):
+            loc[k] = dict((kk, None) for kk in v.keys())
+            n = len(list(v.values())[0])
+        else:
+            loc[k] = None
+            n = len(v)
+    # the fields which are not uint, e.g. str fields decoded by json, keep their dtypes
+    dtypes = {}
+    for path, v in _flatten_loc(loc):
+        a = np.asarray(_get_field(metadata, path))
+        if a.dtype.kind != 'u':
+            dtypes[path[-1]] = a.dtype
+    table = _empty_table(loc, n, dtypes)
+    for path, v in _flatten_loc(loc):
+        _table_column(table, path)[:] = _get_field(metadata, path)
+    return table
+
+# convert time to the int timestamp used by datapff._frametime
+#
+def _totime(t, clock='unix'):
+    if clock == 'unix':
+        scale = 10**6
+    elif clock == 'wr':
+        scale = 10**9
+    else:
+        raise Exception('Clock is not supported: %s'%(clock))
+    if isinstance(t, datetime.datetime):
+        if clock != 'unix':
+            raise Exception('datetime is only supported by unix clock')
+        if t.tzinfo is not None:
+            t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        dt = t - datetime.datetime(1970, 1, 1)
+        return (dt.days*86400 + dt.seconds)*10**6 + dt.microseconds
+    return int(round(t*scale))
+
 class hkpff(object):
     '''
     Description:
@@ -102,27 +870,58 @@ class hkpff(object):
         '''
         self.fn = fn
         self.hk_info = {}
+        # the checkpoint of read_new
+        self.state = None
+        self._boards = {}
+        # the time index of query
+        self._index = hkindex(fn)
                 
-    def readhk(self):
+    def readhk(self, columnar=False, records=False, boards=None, fields=None):
         '''
         Description:
             Read hk.pff, and convert the info to a dict.
+        Inputs:
+            -- columnar(bool): stream the file, and return a numpy array for each field instead of a list.
+                               The type of each field (int, float or str) is derived from the first record
+                               of the board, and Computer_UTC is float. A missing value is 0, nan or ''.
+                               Default = False
+            -- records(bool): return a numpy record array for each board, e.g. hk_info['QUABO_1019']['DET_TEMP'].
+                              It implies columnar.
+                              Default = False
+            -- boards(list): the boards to be read out, e.g. ['GPSSUPP'] or ['QUABO_*'].
+                             The other lines are skipped by checking the bytes at the beginning, without parsing them.
+                             If it's None, all of the boards will be read out.
+                             Default = None
+            -- fields(list): the fields to be read out, e.g. ['DET_TEMP', 'FPGA_TEMP'].
+                             Only these fields are converted.
+                             If it's None, all of the fields will be read out.
+                             Default = None
         Output:
             -- hk_info(dict): a dict contains all of the hk info.
         '''
+        match = _hk_match(boards)
+        fields = _hk_fields(fields)
+        if columnar == True or records == True:
+            return self._readhk_columnar(records, match, fields)
         with open(self.fn, 'rb') as f:
             hk_lines = f.readlines()
         for hk_str in hk_lines:
+            # skip the empty lines without calling the json parser
+            if hk_str.isspace():
+                continue
+            if match is not None and not match(hk_str):
+                continue
             try:
-                hk = json.loads(hk_str)
+                hk = _json_loads(hk_str)
             except:
                 continue
             key, = hk.keys()
+            record = _hk_project(hk[key], fields)
             # check if the key is already in the hk_info
             if(not key in self.hk_info):
-                template = _gen_dict_template(hk[key])
+                template = _gen_dict_template(record)
                 self.hk_info[key] = template
-            for k,v in hk[key].items():
+            for k,v in record.items():
                 # chagne TEMP1 to DET_TEMP, and change TEMP1 to FPGA_TEMP
                 if k == 'TEMP1':
                     k = 'DET_TEMP'
@@ -139,6 +938,171 @@ class hkpff(object):
                         self.hk_info[key][k].append(v)
         return self.hk_info
 
+    def _readhk_columnar(self, records=False, match=None, fields=None):
+        '''
+        Description:
+            Read hk.pff line by line into the typed columns of each board.
+        Inputs:
+            -- records(bool): return a numpy record array for each board.
+                              Default = False
+            -- match(function): check the board name of a line. See _hk_match.
+                                Default = None
+            -- fields(list): the fields in hk.pff to be read out. See _hk_fields.
+                             Default = None
+        Output:
+            -- hk_info(dict): a dict contains the arrays of each board.
+        '''
+        boards = {}
+        with open(self.fn, 'rb') as f:
+            _append_hk(f, boards, match, fields)
+        for key, board in boards.items():
+            arrays = board.arrays()
+            if records == True:
+                arrays = np.rec.fromarrays(list(arrays.values()), names=list(arrays.keys()))
+            self.hk_info[key] = arrays
+        return self.hk_info
+
+    def read_new(self, state=None, chunksize=4<<20):
+        '''
+        Description:
+            Read the lines appended to hk.pff since the last call, and append them to the columnar hk_info.
+            The checkpoint is the byte offset read so far, and the partial line at the end of the file,
+            which is parsed once the rest of the line is written.
+        Input:
+            -- state(dict): the checkpoint, e.g. from load_state.
+                            If it's None, the checkpoint of the last call is used, or the file is read from the beginning.
+                            It's updated in place.
+                            Default = None
+            -- chunksize(int): the new lines are read and parsed in blocks of chunksize bytes,
+                               so only one block is in memory at a time.
+                               Default = 4 MB
+        Output:
+            -- hk_info(dict): a dict contains the arrays of each board, including the new lines.
+        '''
+        if state is None:
+            state = self.state
+        if state is None:
+            state = {'fn': self.fn, 'offset': 0, 'carry': b''}
+        if self.state is not state:
+            self._boards = {}
+        self.state = state
+        with open(self.fn, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < state['offset']:
+                # the file is truncated or replaced, so it's read again from the beginning
+                state['offset'] = 0
+                state['carry'] = b''
+                self._boards = {}
+            f.seek(state['offset'])
+            while state['offset'] < size:
+                buf = f.read(min(chunksize, size - state['offset']))
+                if len(buf) == 0:
+                    break
+                state['offset'] += len(buf)
+                buf = state['carry'] + buf
+                end = buf.rfind(b'\n') + 1
+                state['carry'] = buf[end:]
+                _append_hk(buf[:end].split(b'\n'), self._boards)
+        for key, board in self._boards.items():
+            self.hk_info[key] = board.arrays(copy=False)
+        return self.hk_info
+
+    def build_index(self):
+        '''
+        Description:
+            Build the sparse time index of hk.pff, or extend it with the new lines. See index.hkindex.
+        Output:
+            -- info(dict): the info of the index.
+        '''
+        return self._index.update()
+
+    def query(self, board, fields=None, t0=None, t1=None):
+        '''
+        Description:
+            Read the records of a board with t0 <= Computer_UTC < t1.
+            Only the blocks of the file in the time range are read, which are found by the time index.
+            The index is built or updated first, and it's kept in a sidecar(hk.pff.pffidx).
+        Inputs:
+            -- board(str): the board name, e.g. 'QUABO_1016'.
+            -- fields(list): the fields to be read out, e.g. ['HVMON0', 'DET_TEMP'].
+                             If it's None, all of the fields will be read out.
+                             Default = None
+            -- t0(float or datetime): unix time in seconds, or a datetime, which is UTC if it's naive.
+                                      If it's None, there is no lower bound.
+                                      Default = None
+            -- t1(float or datetime): unix time in seconds, or a datetime, which is UTC if it's naive.
+                                      If it's None, there is no upper bound.
+                                      Default = None
+        Output:
+            -- hk(dict): a numpy array for each field, and Computer_UTC.
+                         It's empty if there is no record in the time range.
+        '''
+        # a naive datetime is UTC, as in read_time_range
+        if isinstance(t0, datetime.datetime):
+            t0 = _totime(t0) / 1e6
+        if isinstance(t1, datetime.datetime):
+            t1 = _totime(t1) / 1e6
+        match = _hk_match([board])
+        keys = None
+        if fields is not None:
+            keys = _hk_fields(['Computer_UTC'] + list(fields))
+        boards = {}
+        with open(self.fn, 'rb') as f:
+            for start, end in self._index.ranges(board, t0, t1):
+                f.seek(start)
+                _append_hk(f.read(end - start).split(b'\n'), boards, match, keys)
+        if board not in boards:
+            return {}
+        arrays = boards[board].arrays()
+        t = arrays['Computer_UTC']
+        sel = np.ones(len(t), dtype=bool)
+        if t0 is not None:
+            sel &= t >= t0
+        if t1 is not None:
+            sel &= t < t1
+        if fields is None:
+            fields = list(arrays.keys())
+        hk = {'Computer_UTC': t[sel]}
+        for k in fields:
+            # TEMP1 and TEMP2 are DET_TEMP and FPGA_TEMP in hk_info
+            k = {'TEMP1': 'DET_TEMP', 'TEMP2': 'FPGA_TEMP'}.get(k, k)
+            if k not in arrays:
+                raise Exception('Field is not found in %s: %s'%(board, k))
+            hk[k] = arrays[k][sel]
+        return hk
+
+    def save_state(self, fn):
+        '''
+        Description:
+            Save the checkpoint of read_new to a json file, so the reading can be resumed after a restart.
+        Input:
+            -- fn(str): file name of the checkpoint.
+        '''
+        if self.state is None:
+            raise Exception('There is no checkpoint: %s'%(self.fn))
+        state = dict(self.state)
+        state['carry'] = state['carry'].decode('latin-1')
+        # write a new file and replace the old one, so the checkpoint is never half written
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(fn + '.tmp', fn)
+
+    @staticmethod
+    def load_state(fn):
+        '''
+        Description:
+            Load the checkpoint saved by save_state.
+        Input:
+            -- fn(str): file name of the checkpoint.
+        Output:
+            -- state(dict): the checkpoint for read_new.
+        '''
+        with open(fn, 'r') as f:
+            state = json.load(f)
+        state['carry'] = state['carry'].encode('latin-1')
+        return state
+
 
 class datapff(object):
     '''
@@ -154,35 +1118,19 @@ class datapff(object):
             -- fn(str): pff file name.
         '''
         self.fn = fn
-        fn_str = fn.split('/')[-1]
-        info = fn_str.split('.')
-        stringIndex = 0
-        if len(info[0]) != 0:
-            stringIndex = 0
-        else:
-            stringIndex = 1
-        startdt_str = info[stringIndex].split('_')[1]
-        stringIndex += 1
-        # It looks like we have two formats of file name
-        try:
-            self.startdt = datetime.datetime.strptime(startdt_str, '%Y-%m-%dT%H:%M:%SZ')
-        except:
-            # macos
-            self.startdt = datetime.datetime.strptime(startdt_str, '%Y-%m-%dT%H-%M-%SZ')
-        self.dp = info[stringIndex].split('_')[1]
-        stringIndex += 1
-        self.bpp = int(info[stringIndex].split('_')[1])
-        stringIndex += 1
-        self.module = int(info[stringIndex].split('_')[1])
-        stringIndex += 1
-        self.seqno = int(info[stringIndex].split('_')[1])
+        info = _parse_fn(fn)
+        self.startdt = info['startdt']
+        self.dp = info['dp']
+        self.bpp = info['bpp']
+        self.module = info['module']
+        self.seqno = info['seqno']
+        # these are the default metadata size and loc, which are used if the file is empty
         if self.dp == 'ph256':
             self._md_size = 124
             self._pixels = 256
             self._d_size = self._pixels * self.bpp
             self.datasize = self._md_size + self._d_size
         else:
-            # TODO: check if the metadata size for ph1024/img16/img8 is the same
             self._md_size = 492
             self._pixels = 1024
             self._d_size = self._pixels * self.bpp
@@ -194,8 +1142,281 @@ class datapff(object):
         else:
             self.dtype = np.uint8
         self.metadata = {}
+        self._md_loc = None
+        self._detect_layout()
+        self.index = pffindex(self)
+        self._buf = None
 
-    def readpff(self, samples=-1, skip = 0, pixel = -1, ver='qfb', metadata=False):
+    def _detect_layout(self):
+        '''
+        Description:
+            Derive the metadata size and loc from the metadata of the first frame,
+            and check them against the metadata of a few frames in the file.
+            If the metadata can't be decoded by the loc, the metadata will be decoded by json.
+        Output:
+            -- md_loc(dict): the metadata loc. It's None if the file is empty.
+        '''
+        try:
+            with open(self.fn, 'rb') as f:
+                md = f.read(_MAX_MD_SIZE)
+        except OSError:
+            return None
+        if md.find(b'*') < 0:
+            return None
+        # the metadata size is derived from the '*', even if the loc can't be derived,
+        # e.g. there is a string field, so the frames are still read at the right offset
+        self._md_size = md.find(b'*') + 1
+        self.datasize = self._md_size + self._d_size
+        sig = md[:md.find(b'*')].translate(_SIGNATURE_TABLE)
+        if (self.dp, sig) not in _layout_cache:
+            _layout_cache[(self.dp, sig)] = _parse_layout(md)
+        layout = _layout_cache[(self.dp, sig)]
+        if layout is None:
+            self._md_loc = {}
+            return self._md_loc
+        md_size, md_loc = layout
+        if self._check_layout(md_loc):
+            self._md_loc = md_loc
+        else:
+            self._md_loc = {}
+        return self._md_loc
+
+    def _check_layout(self, md_loc, samples=8):
+        '''
+        Description:
+            Check the metadata loc against the metadata of a few frames in the file.
+        Inputs:
+            -- md_loc(dict): the metadata loc.
+            -- samples(int): the number of frames to be checked.
+        Output:
+            -- ok(bool): True if the metadata loc is good for all of the frames.
+        '''
+        n = self.nframes()
+        idx = np.unique(np.linspace(0, max(n - 1, 0), min(max(n, 1), samples)).astype(np.int64))
+        fields = _flatten_loc(md_loc)
+        with open(self.fn, 'rb') as f:
+            for i in idx:
+                f.seek(int(i)*self.datasize)
+                md = f.read(self._md_size)
+                if len(md) < self._md_size or md[-1:] != b'*':
+                    return False
+                for path, (r0, r1) in fields:
+                    key = b'"%s":'%(path[-1].encode())
+                    if md[r0 - len(key):r0] != key:
+                        return False
+                    if len(md[r0:r1].strip(b' ')) == 0 or not md[r0:r1].strip(b' ').isdigit():
+                        return False
+                    if md[r1:r1+1].isdigit():
+                        return False
+        return True
+
+    def nframes(self):
+        '''
+        Description:
+            Get the number of complete frames in the data pff file.
+        Output:
+            -- nframes(int): the number of frames.
+        '''
+        return os.path.getsize(self.fn) // self.datasize
+
+    def memmap(self, samples=-1, skip=0):
+        '''
+        Description:
+            Map the data pff file into memory, without reading it.
+            Only the pages touched later will be read from the disk.
+        Input:
+            -- samples(int): The sample number to be mapped.
+                             If it's -1, all of the frames will be mapped.
+                             Default = -1
+            -- skip(int): Skip the number of samples.
+                          Default = 0
+        Output:
+            -- frames(np.memmap): uint8 array with shape (frames, datasize).
+        '''
+        n = max(self.nframes() - skip, 0)
+        if samples != -1:
+            n = min(samples, n)
+        # np.memmap can't map an empty file
+        if n == 0:
+            return np.zeros((0, self.datasize), dtype=np.uint8)
+        return np.memmap(self.fn, dtype=np.uint8, mode='r', offset=skip*self.datasize,
+                         shape=(n, self.datasize))
+
+    def _readframes(self, samples=-1, skip=0, reuse=False):
+        '''
+        Description:
+            Seek to the frame and read the frames out from the data pff file.
+        Input:
+            -- samples(int): The sample number to be read out.
+                             If it's -1, all of the frames after skip will be read out.
+                             Default = -1
+            -- skip(int): Skip the number of samples.
+                          Default = 0
+            -- reuse(bool): read the frames into a buffer kept by the object with readinto,
+                            so there is no new allocation when the buffer is large enough.
+                            The frames are only valid until the next read.
+                            Default = False
+        Output:
+            -- frames(np.array): uint8 array with shape (frames, datasize).
+        '''
+        with open(self.fn, 'rb') as f:
+            f.seek(skip*self.datasize)
+            if reuse == True:
+                if samples == -1:
+                    samples = max(self.nframes() - skip, 0)
+                if self._buf is None or len(self._buf) < samples*self.datasize:
+                    self._buf = bytearray(samples*self.datasize)
+                n = f.readinto(memoryview(self._buf)[:samples*self.datasize])
+                frames = np.frombuffer(self._buf, dtype=np.uint8)[:n]
+            elif samples == -1:
+                frames = np.frombuffer(f.read(), dtype=np.uint8)
+            else:
+                frames = np.frombuffer(f.read(samples*self.datasize), dtype=np.uint8)
+        # drop the incomplete frame at the end of the file, which may be still being written
+        n = frames.shape[0] // self.datasize
+        frames = frames[:n*self.datasize]
+        # reshape the data
+        frames.shape = (-1, self.datasize)
+        return frames
+
+    @property
+    def frames(self):
+        '''
+        Description:
+            Frame-addressed access to the data pff file, e.g. dpff.frames[1000000:1001000].
+            Only the requested frames are read from the disk.
+        Output:
+            -- frames(_frameslicer): slicing it returns (data, metadata), like readpff.
+        '''
+        return _frameslicer(self)
+
+    def frame_dtype(self):
+        '''
+        Description:
+            Get the numpy structured dtype of a frame in this file.
+            See frame_dtype() in this module.
+            If the metadata is decoded by json, 'hdr' is the whole metadata as bytes.
+        Output:
+            -- dtype(np.dtype): structured dtype of a frame.
+        '''
+        loc = self._md_loc
+        if loc is None:
+            loc = self._detect_layout()
+        if loc is None:
+            # the file is empty, so we use the hard-coded one
+            loc = md_loc[self.dp]
+        return frame_dtype(self.dp, self.bpp, loc, self._md_size)
+
+    def records(self, samples=-1, skip=0, mmap=True):
+        '''
+        Description:
+            Get the frames as a numpy structured array, without copying the metadata or the data,
+            e.g. frames['pixels'] or frames['hdr']['pkt_num'].
+            The metadata fields are bytes, which can be converted by .astype(np.uint64).
+        Inputs:
+            -- samples(int): The sample number to be read out.
+                             If it's -1, all of the frames will be read out.
+                             Default = -1
+            -- skip(int): Skip the number of samples.
+                          Default = 0
+            -- mmap(bool): the array is a view of the np.memmap of the file, or a view of the bytes read out.
+                           Default = True
+        Output:
+            -- frames(np.array): structured array with shape (frames,).
+        '''
+        if mmap == True:
+            frames = self.memmap(samples, skip)
+        else:
+            frames = self._readframes(samples, skip)
+        return frames.view(self.frame_dtype())[:, 0]
+
+    def _decode_metadata(self, metadataraw, out=None, table=False, lazy=False):
+        '''
+        Description:
+            Decode the metadata from the raw metadata bytes.
+        Inputs:
+            -- metadataraw(np.array): uint8 array with shape (frames, _md_size - 2).
+            -- out(dict): the output arrays in the same format as the metadata.
+                          The metadata is decoded into them, and the returned arrays are views of them.
+                          Default = None
+            -- table(bool): return the metadata as a compact structured array. See metadata_table.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Output:
+            -- metadata(dict or np.array): a dict contains the metadata from each sample.
+        '''
+        if self.dp not in md_loc:
+            raise Exception('Data type is not supproted: %s'%(self.dp))
+        # get metadata location, which is derived from the first frame
+        metadata_loc = self._md_loc
+        if metadata_loc is None:
+            metadata_loc = self._detect_layout()
+        if metadata_loc is None:
+            # the file was empty when it's opened, so we use the hard-coded one
+            metadata_loc = md_loc[self.dp]
+        n = metadataraw.shape[0]
+        if table == True and out is not None and not isinstance(out, np.ndarray):
+            raise Exception('The output of the metadata table should be a structured array, e.g. from metadata_table')
+        if len(metadata_loc) == 0:
+            if table == True:
+                return _copy_table(metadata_table(self._decode_metadata_json(metadataraw)), out)
+            return _copy_metadata(self._decode_metadata_json(metadataraw), out)
+        # ph1024, img16 and img8 data has two stages of metadata, and ph256 data has one stage of metadata
+        fields = _flatten_loc(metadata_loc)
+        values = None
+        if table == True:
+            # decode the fields into the columns of the table directly
+            if out is None:
+                out = _empty_table(metadata_loc, n)
+            else:
+                _check_table(out, _empty_table(metadata_loc, 0), n)
+                out = out[:n]
+            values = [_table_column(out, path) for path, loc in fields]
+            _ascii2int(metadataraw, [loc for path, loc in fields], values)
+            return out
+        if lazy == True:
+            return lazymetadata(metadataraw, metadata_loc, out)
+        if out is not None:
+            values = [_get_field(out, path) for path, loc in fields]
+        # get the start row and end row from the metadata_loc, and convert all of the fields at once
+        values = _ascii2int(metadataraw, [loc for path, loc in fields], values)
+        metadata = {}
+        for i, (path, loc) in enumerate(fields):
+            d = metadata
+            for k in path[:-1]:
+                d = d.setdefault(k, {})
+            d[path[-1]] = values[i][:n]
+        return metadata
+
+    def _decode_metadata_json(self, metadataraw):
+        '''
+        Description:
+            Decode the metadata frame by frame with json.
+            It's much slower than _decode_metadata, and it's only used when the metadata loc doesn't work.
+        Input:
+            -- metadataraw(np.array): uint8 array with shape (frames, _md_size - 2).
+        Output:
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        md_json = [_json_loads(md.tobytes()) for md in metadataraw]
+        # the int fields are uint64, and the other fields keep their types, e.g. str
+        def _column(values):
+            if all(isinstance(v, int) and v >= 0 for v in values):
+                return np.array(values, dtype=np.uint64)
+            return np.array(values)
+        metadata = {}
+        for k, v in md_json[0].items():
+            if isinstance(v, dict):
+                metadata[k] = {}
+                for kk in v.keys():
+                    metadata[k][kk] = _column([md[k][kk] for md in md_json])
+            else:
+                metadata[k] = _column([md[k] for md in md_json])
+        return metadata
+
+    def readpff(self, samples=-1, skip = 0, pixel = -1, ver='qfb', metadata=False, mmap=False, out=None, md_out=None,
+                stride=1, table=False, lazy=False):
         '''
         Description:
             Read data from a data pff file.
@@ -205,82 +1426,1020 @@ class datapff(object):
                              Default = -1
             -- skip(int): Skip the number of smaples.
                           Default = 0
-            -- pixel(int): select the pixel.
+            -- pixel(int, list, np.array or tuple): select the pixels.
                           If it's -1, we will get the data of all the channels.
+                          It can be a pixel index, a list of pixel indices, a boolean mask with shape
+                          (pixels,) or (dim, dim), or a tuple of (rows, cols) in data.reshape(dim, dim),
+                          e.g. (16, 16) for ph256. This is the order of the pixels in the frame, not the
+                          physical layout. If rows and cols are slices, the data has shape (frames, rows, cols).
+                          For ph256, the pixels can also be selected by their physical location on the quabo,
+                          {'phys': [(x, y), ...], 'quabo': 0}, where x and y start from 1, or by their location
+                          in quabo_config, {'maroc': [(channel, chip), ...], 'quabo': 0}, which uses ver.
+                          The quabo is the quabo_num of the frames, e.g. read_frames(quabo_frames(0), pixel).
+                          Only the selected pixels are copied out from the np.memmap of the file.
                           Default = -1
             -- quabo(int): It specifies the quabo number on the mobo.
                           Default = 0
-            -- ver(str): quabo version.
+            -- ver(str): quabo version, 'qfp' or 'bga'. It's used by the pixel selection of quabo_config locations.
                         Default = 'qfp'
+            -- mmap(bool): map the file into memory instead of reading it.
+                           The data and self.metadataraw are views of the np.memmap,
+                           so only the pages touched later will be read from the disk.
+                           Default = False
+            -- out(np.array): the output array of the data, which has at least `samples` rows.
+                              The data is copied into it, and the returned data is a view of it.
+                              The frames are read into a buffer kept by the object,
+                              so there is no new allocation for each call.
+                              Default = None
+            -- md_out(dict or np.array): the output arrays of the metadata, in the same format as the metadata.
+                             With table=True, it's a structured array like metadata_table returns.
+                             Default = None
+            -- stride(int): read every stride-th frame, e.g. for quick-look.
+                            Only the selected frames are read from the disk. It works with mmap, out and md_out.
+                            Default = 1
+            -- table(bool): return the metadata as a compact structured array instead of a dict.
+                            See metadata_table.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
         Outputs:
             -- metadata(dict): a dict contains the metadata from each sample.
             -- data(np.array): data array.
         '''
-        # get metadata location, which is hard-coded above
-        metadata_loc = md_loc[self.dp]
+        if not isinstance(stride, (int, np.integer)) or stride < 1:
+            raise Exception('stride should be a positive int: %s'%(stride))
+        idx = self._pixel_index(pixel, ver)
+        if idx is not None and not (mmap == True and np.ndim(idx) == 0):
+            # only the selected pixels are copied out
+            return self._readpixels(idx, samples, skip, metadata, out, md_out, table, lazy, stride)
         # read data out from a ph256, img16 or ph1024 file
-        with open(self.fn,'rb') as f:
-            if samples == -1:
-                tmp = np.frombuffer(f.read(),dtype = self.dtype)
-            else:
-                tmp = np.frombuffer(f.read(samples*int(self.datasize/self.bpp)), dtype=self.dtype)
-        # reshape the data
-        tmp.shape = (-1, int(self.datasize/self.bpp))
+        # the offset of the first frame is skip*datasize, so we seek to it directly
+        if stride != 1:
+            # a strided view of the np.memmap, so only the selected frames are read from the disk
+            frames = self.memmap(samples, skip)[::stride]
+            if mmap != True:
+                frames = np.ascontiguousarray(frames)
+        elif mmap == True:
+            frames = self.memmap(samples, skip)
+        else:
+            frames = self._readframes(samples, skip, reuse=out is not None)
         # get data
-        self.data = tmp[:, int(self._md_size/self.bpp):]
-        if metadata==True and tmp.shape[0] != 0:
-            # we need to skip the '* ', which are 2 bytes
-            if self.bpp == 1:
-                metadataraw = tmp[:,0: int(self._md_size/self.bpp) - 2]
-            else:
-                metadataraw = tmp[:,0: int(self._md_size/self.bpp) - 1]
-            metadataraw = metadataraw.tobytes()
-            # convert byte to int8
-            metadataraw = np.frombuffer(metadataraw, dtype=np.int8)
-            metadataraw.shape = (-1, self._md_size - 2) 
-            # create metadata template
-            md_json = json.loads(metadataraw[0].tobytes().decode('utf-8')) 
-            if self.dp == 'ph1024' or self.dp == 'img16' or self.dp == 'img8':
-                # ph1024, img16 and img8 data has two stages of metadata
-                template = _gen_dict_template(md_json)
-                for key in template.keys():
-                    subtemplate = _gen_dict_template(md_json[key])
-                    template[key] = subtemplate
-                self.metadata = template
-                for k in metadata_loc.keys():
-                    for subk in metadata_loc[k].keys():
-                        # get the start row and end row from the metadata_loc
-                        r0 = metadata_loc[k][subk][0]
-                        r1 = metadata_loc[k][subk][1]
-                        tmp = metadataraw[:, r0:r1]
-                        # covert int8 to string
-                        tmp = tmp.view(f'S{r1-r0}')
-                        self.metadata[k][subk] = tmp.astype(np.uint64)
-            elif self.dp == 'ph256':
-                template = _gen_dict_template(md_json)
-                # ph256 data has one stage of metadata
-                self.metadata = template
-                for k in metadata_loc.keys():
-                    # get the start row and end row from the metadata_loc
-                    r0 = metadata_loc[k][0]
-                    r1 = metadata_loc[k][1]
-                    tmp = metadataraw[:, r0:r1]
-                    # covert int8 to string
-                    tmp = tmp.view(f'S{r1-r0}')
-                    self.metadata[k] = tmp.astype(np.uint64)
+        self.data = frames[:, self._md_size:].view(self.dtype)
+        # we need to skip the '* ', which are 2 bytes
+        self.metadataraw = frames[:, 0: self._md_size - 2]
+        if mmap != True and out is not None and metadata == True and lazy == True:
+            # the frames are in the buffer reused by the next read, so the raw metadata
+            # kept by lazymetadata is copied out
+            self.metadataraw = self.metadataraw.copy()
+        if metadata == True:
+            # an empty read has no metadata, so the metadata of the previous read isn't returned
+            self.metadata = {}
+            if frames.shape[0] != 0:
+                self.metadata = self._decode_metadata(self.metadataraw, md_out, table, lazy)
+        if idx is not None:
+            self.data = self.data[:,idx]
+        if out is not None:
+            np.copyto(out[:frames.shape[0]], self.data)
+            self.data = out[:frames.shape[0]]
+        return self.data, self.metadata
+
+
+    def read_frames(self, idx, pixel=-1, metadata=True, table=False, lazy=False):
+        '''
+        Description:
+            Read the selected frames only, from the np.memmap of the file.
+        Inputs:
+            -- idx(list or np.array): frame indices.
+            -- pixel(int, list, np.array or tuple): select the pixels. See readpff.
+                           Default = -1
+            -- metadata(bool): read the metadata out.
+                               Default = True
+            -- table(bool): return the metadata as a compact structured array.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        idx = np.asarray(idx, dtype=np.int64)
+        frames = self.memmap()
+        if len(idx) != 0 and (idx.min() < -frames.shape[0] or idx.max() >= frames.shape[0]):
+            raise IndexError('The frame index is out of range: %d frames'%(frames.shape[0]))
+        frames = frames[idx]
+        self.data = frames[:, self._md_size:].view(self.dtype)
+        self.metadataraw = frames[:, 0: self._md_size - 2]
+        if metadata == True:
+            self.metadata = {}
+            if frames.shape[0] != 0:
+                self.metadata = self._decode_metadata(self.metadataraw, table=table, lazy=lazy)
+        pidx = self._pixel_index(pixel)
+        if pidx is not None:
+            self.data = self.data[:, pidx]
+        return self.data, self.metadata
+
+    def sample(self, n, seed=None, pixel=-1, metadata=True, table=False, lazy=False):
+        '''
+        Description:
+            Read n frames randomly selected from the file, in the order of the frame index.
+        Inputs:
+            -- n(int): the number of frames.
+            -- seed(int): the seed of the random number generator.
+                          Default = None
+            -- pixel(int, list, np.array or tuple): select the pixels. See readpff.
+                           Default = -1
+            -- metadata(bool): read the metadata out.
+                               Default = True
+            -- table(bool): return the metadata as a compact structured array.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        rng = np.random.default_rng(seed)
+        nframes = self.nframes()
+        idx = np.sort(rng.choice(nframes, size=min(n, nframes), replace=False))
+        return self.read_frames(idx, pixel, metadata, table, lazy)
+
+    def _pixel_index(self, pixel, ver='qfp'):
+        '''
+        Description:
+            Convert the pixel selection of readpff to the pixel indices in the frame.
+        Inputs:
+            -- pixel(int, list, np.array, tuple or dict): see readpff.
+            -- ver(str): quabo version, 'qfp' or 'bga'.
+                         Default = 'qfp'
+        Output:
+            -- idx(int or np.array): pixel indices. It's None if all of the pixels are selected.
+        '''
+        if isinstance(pixel, (int, np.integer)):
+            if pixel == -1:
+                return None
+            if not -self._pixels <= pixel < self._pixels:
+                raise Exception('The pixel index is out of range: %d pixels'%(self._pixels))
+            return int(pixel)
+        if isinstance(pixel, dict):
+            # the pixel map only works for the 16x16 pixels of a quabo
+            if self.dp != 'ph256':
+                raise Exception('The pixels can be selected by location only for ph256: %s'%(self.dp))
+            quabo = pixel.get('quabo', 0)
+            if quabo not in range(4):
+                raise Exception('The quabo should be 0, 1, 2 or 3: %s'%(quabo))
+            if 'phys' in pixel:
+                for x, y in pixel['phys']:
+                    if not (1 <= x <= pixelmap.SRC_DIM and 1 <= y <= pixelmap.SRC_DIM):
+                        raise Exception('The physical pixel location should be in [1, %d]: (%s, %s)'%(pixelmap.SRC_DIM, x, y))
+                idx = [pixelmap.get_phys_data_index(quabo, loc) for loc in pixel['phys']]
+            elif 'maroc' in pixel:
+                # 'qfb' is the old default of readpff
+                if ver == 'qfb':
+                    ver = 'qfp'
+                idx = [pixelmap.get_data_index(quabo, ver, loc) for loc in pixel['maroc']]
             else:
-                raise Exception('Data type is not supproted: %s'%(self.dp))
+                raise Exception("The pixels should be selected by {'phys': locs} or {'maroc': locs}")
+            pixel = idx
+        dim = int(np.sqrt(self._pixels))
+        if isinstance(pixel, tuple):
+            if len(pixel) != 2:
+                raise Exception('The pixels should be selected by (rows, cols)')
+            rows, cols = pixel
+            if isinstance(rows, slice) and isinstance(cols, slice):
+                # region of interest
+                return np.add.outer(np.arange(dim)[rows]*dim, np.arange(dim)[cols])
+            if isinstance(rows, slice):
+                rows = np.arange(dim)[rows]
+            if isinstance(cols, slice):
+                cols = np.arange(dim)[cols]
+            rows = np.asarray(rows, dtype=np.int64)
+            cols = np.asarray(cols, dtype=np.int64)
+            if (rows.size != 0 and (rows.min() < 0 or rows.max() >= dim)) or (cols.size != 0 and (cols.min() < 0 or cols.max() >= dim)):
+                raise Exception('The rows and cols should be in [0, %d)'%(dim))
+            return rows*dim + cols
+        pixel = np.asarray(pixel)
+        if pixel.dtype == bool:
+            if pixel.shape != (self._pixels,) and pixel.shape != (dim, dim):
+                raise Exception('The shape of the pixel mask should be (%d,) or (%d, %d)'%(self._pixels, dim, dim))
+            return np.flatnonzero(pixel)
+        pixel = pixel.astype(np.int64)
+        if pixel.size != 0 and (pixel.min() < -self._pixels or pixel.max() >= self._pixels):
+            raise Exception('The pixel index is out of range: %d pixels'%(self._pixels))
+        return pixel
+
+    def _readpixels(self, idx, samples=-1, skip=0, metadata=False, out=None, md_out=None, table=False, lazy=False,
+                    stride=1):
+        '''
+        Description:
+            Copy the selected pixels out from the np.memmap of the file chunk by chunk,
+            so there is no temporary array of the whole frames.
+        Inputs:
+            -- idx(int or np.array): pixel indices.
+            -- others: see readpff.
+        Outputs:
+            -- data(np.array): data array with shape (frames,) + idx.shape.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        frames = self.memmap(samples, skip)[::stride]
+        n = frames.shape[0]
+        data = frames[:, self._md_size:].view(self.dtype)
+        if out is None:
+            out = np.empty((n,) + np.shape(idx), dtype=self.dtype)
+        for c in range(0, n, _DECODE_FRAMES):
+            e = min(c + _DECODE_FRAMES, n)
+            out[c:e] = data[c:e, idx]
+        self.data = out[:n]
+        self.metadataraw = frames[:, 0: self._md_size - 2]
+        if metadata == True:
+            self.metadata = {}
+            if n != 0:
+                self.metadata = self._decode_metadata(self.metadataraw, md_out, table, lazy)
+        return self.data, self.metadata
+
+    def read_metadata(self, samples=-1, skip=0, stride=1, table=False, lazy=False):
+        '''
+        Description:
+            Read the metadata only, without copying the data out.
+            The metadata fields are decoded from a strided view of the np.memmap of the file,
+            so the data part of each frame is never copied into memory.
+        Inputs:
+            -- samples(int): The sample number to be read out.
+                             If it's -1, all of the metadata will be read out.
+                             Default = -1
+            -- skip(int): Skip the number of samples.
+                          Default = 0
+            -- stride(int): read the metadata of every stride-th frame.
+                            Default = 1
+            -- table(bool): return the metadata as a compact structured array. See metadata_table.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Output:
+            -- metadata(dict or np.array): a dict contains the metadata from each sample.
+        '''
+        # the metadata in the index is used if it's available
+        metadata = self.index.metadata(samples, skip)
+        if metadata is not None:
+            if stride != 1:
+                metadata = _slice_metadata(metadata, slice(None, None, stride))
+            if table == True:
+                metadata = metadata_table(metadata)
+            self.metadata = metadata
+            return self.metadata
+        frames = self.memmap(samples, skip)[::stride]
+        if frames.shape[0] == 0:
+            self.metadata = {}
+            return self.metadata
+        self.metadata = self._decode_metadata(frames[:, 0: self._md_size - 2], table=table, lazy=lazy)
+        return self.metadata
+
+    def build_index(self):
+        '''
+        Description:
+            Build the sidecar index of the file, which is used by read_metadata, read_time_range,
+            quabo_frames and packet_loss automatically. See pypff.index.
+        Output:
+            -- info(dict): the info of the index.
+        '''
+        return self.index.build()
+
+    def quabo_frames(self, quabo):
+        '''
+        Description:
+            Get the indices of the frames from a quabo.
+            For ph1024, img16 and img8, every frame contains the data from all of the quabos.
+        Input:
+            -- quabo(int): quabo number on the mobo.
+        Output:
+            -- idx(np.array): frame indices.
+        '''
+        if self.dp != 'ph256':
+            return np.arange(self.nframes())
+        arrays = self.index.load()
+        if arrays is not None:
+            quabo_num = arrays['quabo_num']
+        else:
+            quabo_num = self.read_metadata()['quabo_num']
+        return np.nonzero(quabo_num == quabo)[0]
+
+    def packet_loss(self):
+        '''
+        Description:
+            Count the lost packets of each quabo from the gaps of pkt_num.
+        Output:
+            -- loss(dict): the number of lost packets of each quabo,
+                           keyed by quabo_num for ph256, or by 'quabo_0'...'quabo_3' for the others.
+        '''
+        md = self.read_metadata()
+        loss = {}
         if self.dp == 'ph256':
-            for k in self.metadata.keys():
-                self.metadata[k] = np.array(self.metadata[k].flat)
-        elif self.dp == 'img16' or self.dp == 'img8' or self.dp == 'ph1024':
-            for k in self.metadata.keys():
-                for kk in self.metadata[k].keys():
-                    self.metadata[k][kk] = np.array(self.metadata[k][kk].flat)
-        if pixel != -1:
-            self.data = self.data[:,pixel]
+            pkt = {}
+            for q in np.unique(md['quabo_num']):
+                pkt[int(q)] = md['pkt_num'][md['quabo_num'] == q]
+        else:
+            pkt = {}
+            for k in md.keys():
+                pkt[k] = md[k]['pkt_num']
+        for k, v in pkt.items():
+            gap = np.diff(v.astype(np.int64)) % PKT_NUM_MOD
+            loss[k] = int(np.sum(gap[gap > 0] - 1))
+        return loss
+
+    def _readheaders(self, idx):
+        '''
+        Description:
+            Read and decode the metadata of the selected frames only, without reading the data.
+        Input:
+            -- idx(list): frame indices.
+        Output:
+            -- metadata(dict): a dict contains the metadata of the selected frames.
+        '''
+        mdraw = np.zeros((len(idx), self._md_size - 2), dtype=np.uint8)
+        with open(self.fn, 'rb') as f:
+            for i, k in enumerate(idx):
+                f.seek(int(k)*self.datasize)
+                mdraw[i] = np.frombuffer(f.read(self._md_size - 2), dtype=np.uint8)
+        return self._decode_metadata(mdraw)
+
+    def _frametime(self, metadata, clock='unix'):
+        '''
+        Description:
+            Get the timestamp of each frame from the metadata.
+            For ph1024, img16 and img8, the latest timestamp of the quabos is used.
+        Inputs:
+            -- metadata(dict): a dict contains the metadata.
+            -- clock(str): 'unix' uses tv_sec/tv_usec, and the unit is micro second.
+                           'wr' uses pkt_tai/pkt_nsec, and the unit is nano second.
+        Output:
+            -- t(np.array): int64 timestamp array.
+        '''
+        if clock == 'unix':
+            sec, subsec, scale = 'tv_sec', 'tv_usec', 10**6
+        elif clock == 'wr':
+            sec, subsec, scale = 'pkt_tai', 'pkt_nsec', 10**9
+        else:
+            raise Exception('Clock is not supported: %s'%(clock))
+        if self.dp == 'ph256':
+            return metadata[sec].astype(np.int64)*scale + metadata[subsec].astype(np.int64)
+        t = [metadata[k][sec].astype(np.int64)*scale + metadata[k][subsec].astype(np.int64) for k in metadata.keys()]
+        return np.max(t, axis=0)
+
+    def _searchtime(self, t, clock='unix', side='left'):
+        '''
+        Description:
+            Binary search the frame index for the timestamp, by reading the metadata of a few frames.
+        Inputs:
+            -- t(int): timestamp in the unit of _frametime.
+            -- clock(str): 'unix' or 'wr'.
+            -- side(str): 'left' returns the first frame with time >= t,
+                          'right' returns the first frame with time > t.
+        Output:
+            -- index(int): frame index.
+        '''
+        # the timestamps in the index are used if it's available
+        arrays = self.index.load()
+        if arrays is not None:
+            return int(np.searchsorted(arrays['t_' + clock], t, side))
+        lo = 0
+        hi = self.nframes()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            tmid = self._frametime(self._readheaders([mid]), clock)[0]
+            if tmid < t or (side == 'right' and tmid == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_time_range(self, t0, t1, clock='unix', pixel=-1, metadata=True, mmap=False):
+        '''
+        Description:
+            Read the frames with t0 <= timestamp < t1.
+            The frame is found by binary search on the metadata, so only a few frames are read
+            before reading the data. It assumes the timestamps in the file are in order.
+        Inputs:
+            -- t0, t1(float or datetime): start and end time.
+                        For clock='unix', it's the unix time in second, or a datetime in UTC.
+                        For clock='wr', it's pkt_tai + pkt_nsec*10**-9 in second.
+                        Please note that pkt_tai is only the lower bits of the White Rabbit TAI second.
+            -- clock(str): 'unix' uses tv_sec/tv_usec, and 'wr' uses pkt_tai/pkt_nsec.
+                           Default = 'unix'
+            -- pixel(int): select the pixel.
+                           Default = -1
+            -- metadata(bool): read the metadata out.
+                               Default = True
+            -- mmap(bool): map the file into memory instead of reading it.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        t0 = _totime(t0, clock)
+        t1 = _totime(t1, clock)
+        i0 = self._searchtime(t0, clock, 'left')
+        i1 = self._searchtime(t1, clock, 'left')
+        return self.readpff(samples=max(i1 - i0, 0), skip=i0, pixel=pixel, metadata=metadata, mmap=mmap)
+
+    def _iter_frames(self, frames_per_chunk=1024, reuse=False, prefetch=0, fadvise=False):
+        '''
+        Description:
+            Read the frames chunk by chunk. It's used by iter_chunks.
+        Output:
+            -- frames(np.array): uint8 array with shape (frames, datasize).
+        '''
+        chunksize = frames_per_chunk * self.datasize
+        fadvise = fadvise == True and hasattr(os, 'posix_fadvise')
+        with open(self.fn, 'rb') as f:
+            if fadvise:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if prefetch > 0:
+                reader = _prefetcher(f, chunksize, prefetch)
+            else:
+                reader = _read_chunks(f, chunksize, reuse)
+            offset = 0
+            try:
+                for buf, n in reader:
+                    # drop the incomplete frame at the end of the file
+                    n = n // self.datasize
+                    if n == 0:
+                        break
+                    yield np.frombuffer(buf, dtype=np.uint8)[:n*self.datasize].reshape(n, self.datasize)
+                    # the chunk has been processed, so we drop it from the page cache
+                    if fadvise:
+                        os.posix_fadvise(f.fileno(), offset, n*self.datasize, os.POSIX_FADV_DONTNEED)
+                    offset += n*self.datasize
+                    if n < frames_per_chunk:
+                        break
+            finally:
+                reader.close()
+
+    def iter_chunks(self, frames_per_chunk=1024, metadata=True, reuse=False, prefetch=0, fadvise=False,
+                    out=None, md_out=None, table=False, lazy=False):
+        '''
+        Description:
+            Read the data pff file chunk by chunk, so the memory usage doesn't depend on the file size.
+        Inputs:
+            -- frames_per_chunk(int): the number of frames in each chunk.
+                                      The last chunk may be shorter.
+                                      Default = 1024
+            -- metadata(bool): decode the metadata of each chunk.
+                               Default = True
+            -- reuse(bool): read every chunk into the same preallocated buffer.
+                            The data of a chunk is only valid until the next chunk is read.
+                            Default = False
+            -- prefetch(int): the number of chunks read ahead by a background thread.
+                              The chunks are read into a ring of preallocated buffers,
+                              so the data of a chunk is only valid until the next chunk is read.
+                              If it's 0, the chunks are read when they're needed.
+                              Default = 0
+            -- fadvise(bool): tell the kernel that the file is read sequentially, and drop the chunks
+                              from the page cache after they're processed (posix_fadvise).
+                              It keeps a long scan from pushing everything else out of the page cache.
+                              Default = False
+            -- out(np.array): the output array of the data, which has at least frames_per_chunk rows.
+                              The data of every chunk is copied into it.
+                              Default = None
+            -- md_out(dict or np.array): the output arrays of the metadata, in the same format as the metadata.
+                             With table=True, it's a structured array like metadata_table returns.
+                             Default = None
+            -- table(bool): return the metadata as a compact structured array.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array of the chunk.
+            -- metadata(dict): a dict contains the metadata of the chunk.
+                               It's empty if metadata is False.
+        '''
+        for frames in self._iter_frames(frames_per_chunk, reuse, prefetch, fadvise):
+            data = frames[:, self._md_size:].view(self.dtype)
+            if out is not None:
+                np.copyto(out[:frames.shape[0]], data)
+                data = out[:frames.shape[0]]
+            md = {}
+            if metadata == True:
+                metadataraw = frames[:, 0: self._md_size - 2]
+                if lazy == True and (reuse == True or prefetch > 0):
+                    # the buffer is overwritten by the next chunk
+                    metadataraw = metadataraw.copy()
+                md = self._decode_metadata(metadataraw, md_out, table, lazy)
+            yield data, md
+
+    def follow(self, frames_per_chunk=1024, metadata=True, poll=1.0, marker='recording_ended', timeout=None):
+        '''
+        Description:
+            Read the new frames of a file which is still being written by hashpipe.
+            Only the complete frames are read, and an incomplete frame at the end of the file
+            is read after it's written. It stops when the marker file appears in the run directory,
+            or when the next seqno file appears, after all of the frames are read.
+        Inputs:
+            -- frames_per_chunk(int): the max number of frames in each chunk.
+                                      Default = 1024
+            -- metadata(bool): decode the metadata of each chunk.
+                               Default = True
+            -- poll(float): the interval of checking the file size in second.
+                            Default = 1.0
+            -- marker(str): the file name which means the recording is ended.
+                            Default = 'recording_ended'
+            -- timeout(float): stop if there is no new frame in timeout seconds.
+                               If it's None, it never times out.
+                               Default = None
+        Outputs:
+            -- data(np.array): data array of the new frames.
+            -- metadata(dict): a dict contains the metadata of the new frames.
+        '''
+        run_dir = os.path.dirname(self.fn)
+        info = _parse_fn(self.fn)
+        next_fn = self.fn.replace('.seqno_%d.'%(info['seqno']), '.seqno_%d.'%(info['seqno'] + 1))
+        skip = 0
+        last = time.time()
+        while True:
+            # check it before reading, so the frames written before the marker are all read
+            ended = os.path.exists(os.path.join(run_dir, marker)) or (next_fn != self.fn and os.path.exists(next_fn))
+            if self._md_loc is None:
+                # the file was empty when it's opened
+                self._detect_layout()
+            n = 0
+            if self._md_loc is not None:
+                try:
+                    n = self.nframes() - skip
+                except OSError:
+                    n = 0
+            while n > 0:
+                frames = self._readframes(min(n, frames_per_chunk), skip)
+                if frames.shape[0] == 0:
+                    break
+                data = frames[:, self._md_size:].view(self.dtype)
+                md = {}
+                if metadata == True:
+                    md = self._decode_metadata(frames[:, 0: self._md_size - 2])
+                yield data, md
+                skip += frames.shape[0]
+                n -= frames.shape[0]
+                last = time.time()
+            if ended:
+                break
+            if timeout is not None and time.time() - last > timeout:
+                break
+            time.sleep(poll)
+
+class _frameslicer(object):
+    '''
+    Description:
+        Slicing helper returned by datapff.frames.
+    '''
+    def __init__(self, dpff):
+        self.dpff = dpff
+
+    def __len__(self):
+        return self.dpff.nframes()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('Only slices are supported, e.g. frames[i:j]')
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            if not hasattr(self.dpff, 'read_frames'):
+                raise ValueError('The slice step is not supported: %d'%(step))
+            return self.dpff.read_frames(np.arange(start, stop, step), metadata=True)
+        return self.dpff.readpff(samples=max(stop - start, 0), skip=start, metadata=True)
+
+
+class pffseries(object):
+    '''
+    Description:
+        The pffseries class reads the seqno_0..N files of a data product from a module as one dataset.
+        The DAQ starts a new file when the file size reaches max_file_size_mb, so the frames of a run
+        are split into several files.
+    '''
+    def __init__(self, files, max_open=8):
+        '''
+        Description:
+            Create a pffseries object from the pff files.
+            The files are opened when they're read, and at most max_open files are kept open.
+        Inputs:
+            -- files(list or str): pff file names, or a glob pattern.
+                                   They should have the same start time, dp, bpp and module.
+            -- max_open(int): the max number of files kept open.
+                              Default = 8
+        '''
+        if isinstance(files, str):
+            files = glob(files)
+        if len(files) == 0:
+            raise Exception('No pff file is found!')
+        infos = [_parse_fn(fn) for fn in files]
+        key = _series_key(infos[0])
+        for fn, info in zip(files, infos):
+            if _series_key(info) != key:
+                raise Exception('%s is not in the same series as %s, please use pffseries.group()'%(fn, files[0]))
+        order = np.argsort([info['seqno'] for info in infos], kind='stable')
+        self.files = [files[i] for i in order]
+        self.startdt, self.dp, self.bpp, self.module = key
+        self.max_open = max_open
+        self._open_files = OrderedDict()
+        self.datasize = self._open(0).datasize
+        self.data = None
+        self.metadata = {}
+
+    @staticmethod
+    def group(files, max_open=8):
+        '''
+        Description:
+            Group the pff files by start time, dp, bpp and module.
+        Inputs:
+            -- files(list or str): pff file names, or a glob pattern.
+            -- max_open(int): the max number of files kept open by each pffseries.
+                              Default = 8
+        Output:
+            -- series(dict): pffseries objects, keyed by (startdt, dp, bpp, module).
+        '''
+        if isinstance(files, str):
+            files = glob(files)
+        groups = OrderedDict()
+        for fn in sorted(files):
+            groups.setdefault(_series_key(_parse_fn(fn)), []).append(fn)
+        return OrderedDict((k, pffseries(v, max_open)) for k, v in groups.items())
+
+    def _open(self, i):
+        '''
+        Description:
+            Get the datapff object and its np.memmap of the i-th file.
+            The least recently used file is closed when there are more than max_open files.
+        '''
+        if i in self._open_files:
+            self._open_files.move_to_end(i)
+        else:
+            self._open_files[i] = [datapff(self.files[i]), None]
+            while len(self._open_files) > self.max_open:
+                self._open_files.popitem(last=False)
+        return self._open_files[i][0]
+
+    def _memmap(self, i):
+        dpff = self._open(i)
+        entry = self._open_files[i]
+        if entry[1] is None or entry[1].shape[0] != dpff.nframes():
+            entry[1] = dpff.memmap()
+        return entry[1]
+
+    def _nframes_per_file(self):
+        return np.array([os.path.getsize(fn) // self.datasize for fn in self.files], dtype=np.int64)
+
+    def nframes(self):
+        '''
+        Description:
+            Get the number of frames in all of the files.
+        Output:
+            -- nframes(int): the number of frames.
+        '''
+        return int(np.sum(self._nframes_per_file()))
+
+    def _spans(self, samples=-1, skip=0):
+        '''
+        Description:
+            Split the global frame range into (file, local skip, local samples).
+        '''
+        counts = self._nframes_per_file()
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        end = starts[-1]
+        if samples != -1:
+            end = min(end, skip + samples)
+        spans = []
+        for i in range(len(self.files)):
+            i0 = max(skip, starts[i])
+            i1 = min(end, starts[i+1])
+            if i1 > i0:
+                spans.append((i, int(i0 - starts[i]), int(i1 - i0)))
+        return spans
+
+    @property
+    def frames(self):
+        '''
+        Description:
+            Frame-addressed access to all of the files, e.g. series.frames[1000000:1001000].
+        Output:
+            -- frames(_frameslicer): slicing it returns (data, metadata), like readpff.
+        '''
+        return _frameslicer(self)
+
+    def readpff(self, samples=-1, skip=0, pixel=-1, ver='qfb', metadata=False, mmap=False, table=False, lazy=False):
+        '''
+        Description:
+            Read data from the files, as if they are one file. See datapff.readpff.
+            If the frames are in more than one file, the data is copied into one array.
+            The selected pixels are copied out of each file, so there is no temporary array of the whole frames.
+        Inputs:
+            -- samples(int): The sample number to be read out.
+                             If it's -1, all of the data will be read out.
+                             Default = -1
+            -- skip(int): Skip the number of smaples.
+                          Default = 0
+            -- pixel(int, list, np.array, tuple or dict): select the pixels. See datapff.readpff.
+                           Default = -1
+            -- ver(str): board version, which is used to get the pixel index from the pixel location in quabo_config.
+                         Default = 'qfb'
+            -- metadata(bool): read the metadata out.
+                               Default = False
+            -- mmap(bool): read the frames from the np.memmap of the files.
+                           Default = False
+            -- table(bool): return the metadata as a compact structured array.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        idx = self._open(0)._pixel_index(pixel, ver)
+        data = []
+        mds = []
+        for i, s, n in self._spans(samples, skip):
+            dpff = self._open(i)
+            if idx is not None and not (mmap == True and np.ndim(idx) == 0):
+                # only the selected pixels are copied out of the file
+                d, md = dpff._readpixels(idx, n, s, metadata, table=table, lazy=lazy)
+                data.append(d)
+                if metadata == True:
+                    mds.append(md)
+                continue
+            if mmap == True:
+                frames = self._memmap(i)[s:s+n]
+            else:
+                frames = dpff._readframes(n, s)
+            d = frames[:, dpff._md_size:].view(dpff.dtype)
+            if idx is not None:
+                d = d[:, idx]
+            data.append(d)
+            if metadata == True:
+                mds.append(dpff._decode_metadata(frames[:, 0: dpff._md_size - 2], table=table, lazy=lazy))
+        if len(data) == 0:
+            dpff = self._open(0)
+            self.data = np.zeros((0, dpff._pixels), dtype=dpff.dtype)
+            if idx is not None:
+                self.data = self.data[:, idx]
+        elif len(data) == 1:
+            self.data = data[0]
+        else:
+            self.data = np.concatenate(data)
+        if metadata == True:
+            self.metadata = _concat_metadata(mds)
         return self.data, self.metadata
 
+    def read_metadata(self, samples=-1, skip=0, table=False, lazy=False):
+        '''
+        Description:
+            Read the metadata only. See datapff.read_metadata.
+        Inputs:
+            -- samples(int): The sample number to be read out.
+                             If it's -1, all of the metadata will be read out.
+                             Default = -1
+            -- skip(int): Skip the number of samples.
+                          Default = 0
+            -- table(bool): return the metadata as a compact structured array.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Output:
+            -- metadata(dict or np.array): a dict contains the metadata from each sample.
+        '''
+        self.metadata = _concat_metadata([self._open(i).read_metadata(n, s, table=table, lazy=lazy) for i, s, n in self._spans(samples, skip)])
+        return self.metadata
+
+    def read_time_range(self, t0, t1, clock='unix', pixel=-1, metadata=True, mmap=False):
+        '''
+        Description:
+            Read the frames with t0 <= timestamp < t1 from all of the files.
+            See datapff.read_time_range.
+        Inputs:
+            -- t0, t1(float or datetime): start and end time.
+            -- clock(str): 'unix' uses tv_sec/tv_usec, and 'wr' uses pkt_tai/pkt_nsec.
+                           Default = 'unix'
+            -- pixel(int): select the pixel.
+                           Default = -1
+            -- metadata(bool): read the metadata out.
+                               Default = True
+            -- mmap(bool): read the frames from the np.memmap of the files.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array.
+            -- metadata(dict): a dict contains the metadata from each sample.
+        '''
+        t0 = _totime(t0, clock)
+        t1 = _totime(t1, clock)
+        # the frames are in order, so the global index is the sum of the local indices
+        i0 = 0
+        i1 = 0
+        for i in range(len(self.files)):
+            dpff = self._open(i)
+            i0 += dpff._searchtime(t0, clock, 'left')
+            i1 += dpff._searchtime(t1, clock, 'left')
+        return self.readpff(samples=max(i1 - i0, 0), skip=i0, pixel=pixel, metadata=metadata, mmap=mmap)
+
+    def iter_chunks(self, frames_per_chunk=1024, metadata=True, reuse=False, prefetch=0, fadvise=False,
+                    out=None, md_out=None, table=False, lazy=False):
+        '''
+        Description:
+            Read the files chunk by chunk. See datapff.iter_chunks.
+            A chunk doesn't cross files, so the last chunk of each file may be shorter.
+        Inputs:
+            -- frames_per_chunk(int): the number of frames in each chunk.
+                                      Default = 1024
+            -- metadata(bool): decode the metadata of each chunk.
+                               Default = True
+            -- reuse(bool): read every chunk into the same preallocated buffer.
+                            Default = False
+            -- prefetch(int): the number of chunks read ahead by a background thread.
+                              Default = 0
+            -- fadvise(bool): drop the chunks from the page cache after they're processed.
+                              Default = False
+            -- out(np.array): the output array of the data.
+                              Default = None
+            -- md_out(dict or np.array): the output arrays of the metadata, or a table with table=True.
+                             Default = None
+            -- table(bool): return the metadata as a compact structured array.
+                            Default = False
+            -- lazy(bool): return the metadata as a lazymetadata, which decodes a field when it's first accessed.
+                           Default = False
+        Outputs:
+            -- data(np.array): data array of the chunk.
+            -- metadata(dict): a dict contains the metadata of the chunk.
+        '''
+        for i in range(len(self.files)):
+            for data, md in self._open(i).iter_chunks(frames_per_chunk, metadata, reuse, prefetch, fadvise,
+                                                      out, md_out, table, lazy):
+                yield data, md
+
+
+class _pffstream(object):
+    '''
+    Description:
+        The frames of a pffseries in chunks, with a cursor, which is used by pffrun.
+    '''
+    def __init__(self, series, clock='unix', frames_per_chunk=1024):
+        self.series = series
+        self.clock = clock
+        self._dpff = series._open(0)
+        self._chunks = series.iter_chunks(frames_per_chunk, metadata=True)
+        self._next()
+
+    def _next(self):
+        for data, md in self._chunks:
+            if data.shape[0] == 0:
+                continue
+            self.data = data
+            self.md = md
+            self.t = self._dpff._frametime(md, self.clock)
+            self.cursor = 0
+            return True
+        self.data = None
+        return False
+
+    def done(self):
+        return self.data is None
+
+    def head(self):
+        return self.t[self.cursor]
+
+    def take(self, t, side='left', min_frames=0):
+        '''
+        Description:
+            Take the frames with timestamp < t (side='left') or <= t (side='right'),
+            and at least min_frames frames.
+        '''
+        data = []
+        mds = []
+        while self.data is not None:
+            end = self.cursor + int(np.searchsorted(self.t[self.cursor:], t, side))
+            end = min(max(end, self.cursor + min_frames), len(self.t))
+            min_frames -= end - self.cursor
+            if end > self.cursor:
+                data.append(self.data[self.cursor:end])
+                mds.append(_slice_metadata(self.md, slice(self.cursor, end)))
+            self.cursor = end
+            if self.cursor < len(self.t):
+                break
+            self._next()
+        if len(data) == 0:
+            return None, {}
+        if len(data) == 1:
+            return data[0], mds[0]
+        return np.concatenate(data), _concat_metadata(mds)
+
+
+class pffrun(object):
+    '''
+    Description:
+        The pffrun class reads the data files of all the modules in a run, and merges them by timestamp.
+        The memory usage depends on the number of modules, not the size of the files.
+    '''
+    def __init__(self, files, dp=None, clock='unix', frames_per_chunk=1024):
+        '''
+        Description:
+            Create a pffrun object.
+        Inputs:
+            -- files(str or list): a run directory, a glob pattern, or a list of pff files or run directories.
+                                   The run directories are searched recursively, so the data from
+                                   several DAQ nodes can be read together.
+            -- dp(str): data product to be read, e.g. 'img16'.
+                        It can be None if there is only one data product in the run.
+                        Default = None
+            -- clock(str): 'unix' uses tv_sec/tv_usec, and 'wr' uses pkt_tai/pkt_nsec.
+                           Default = 'unix'
+            -- frames_per_chunk(int): the number of frames read from each module at once.
+                                     Default = 1024
+        '''
+        if isinstance(files, str):
+            files = [files]
+        fns = []
+        for fn in files:
+            if os.path.isdir(fn):
+                fns += glob(os.path.join(fn, '**', '*.pff'), recursive=True)
+            else:
+                fns += glob(fn)
+        # hk.pff is not a data file
+        fns = [fn for fn in fns if os.path.basename(fn).startswith('start_')]
+        series = pffseries.group(fns)
+        dps = sorted(set(k[1] for k in series.keys()))
+        if dp is None:
+            if len(dps) != 1:
+                raise Exception('Please specify the data product: %s'%(', '.join(dps)))
+            dp = dps[0]
+        self.dp = dp
+        self.clock = clock
+        self.frames_per_chunk = frames_per_chunk
+        self.series = OrderedDict()
+        for k, v in series.items():
+            if k[1] == dp:
+                if k[3] in self.series:
+                    raise Exception('Module %d has more than one series of %s'%(k[3], dp))
+                self.series[k[3]] = v
+        if len(self.series) == 0:
+            raise Exception('No %s file is found!'%(dp))
+        self.modules = list(self.series.keys())
+
+    def iter_merged(self):
+        '''
+        Description:
+            Iterate over the frames of all the modules in the order of timestamp (k-way merge).
+            Each batch contains the consecutive frames of one module, which are earlier than
+            the next frame of the other modules.
+        Outputs:
+            -- module(int): module id.
+            -- data(np.array): data array of the batch.
+            -- metadata(dict): a dict contains the metadata of the batch.
+        '''
+        streams = {m: _pffstream(s, self.clock, self.frames_per_chunk) for m, s in self.series.items()}
+        heap = [(st.head(), m) for m, st in streams.items() if not st.done()]
+        heapq.heapify(heap)
+        while len(heap) != 0:
+            t, m = heapq.heappop(heap)
+            st = streams[m]
+            if len(heap) != 0:
+                data, md = st.take(heap[0][0], 'right', 1)
+            else:
+                data, md = st.take(np.iinfo(np.int64).max, 'left', 1)
+            yield m, data, md
+            if not st.done():
+                heapq.heappush(heap, (st.head(), m))
+
+    def iter_binned(self, width):
+        '''
+        Description:
+            Iterate over the frames of all the modules in time bins.
+            The empty bins are skipped.
+        Input:
+            -- width(float): bin width in second.
+        Outputs:
+            -- t(float): start time of the bin in second.
+            -- batch(dict): (data, metadata) of the frames in the bin, keyed by module id.
+        '''
+        if self.clock == 'unix':
+            scale = 10**6
+        else:
+            scale = 10**9
+        width = _totime(width, self.clock)
+        if width <= 0:
+            raise Exception('The bin width should be > 0')
+        streams = {m: _pffstream(s, self.clock, self.frames_per_chunk) for m, s in self.series.items()}
+        heads = [st.head() for st in streams.values() if not st.done()]
+        if len(heads) == 0:
+            return
+        t0 = min(heads)
+        b0 = t0
+        while True:
+            heads = [st.head() for st in streams.values() if not st.done()]
+            if len(heads) == 0:
+                break
+            # skip the empty bins
+            b0 = max(b0, t0 + (min(heads) - t0) // width * width)
+            b1 = b0 + width
+            batch = OrderedDict()
+            for m, st in streams.items():
+                data, md = st.take(b1, 'left')
+                if data is not None:
+                    batch[m] = (data, md)
+            if len(batch) != 0:
+                yield b0 / scale, batch
+            b0 = b1
 
 
 class qconfig(object):
@@ -0,0 +1,77 @@
+'''
+This module provides methods to process many data pff files in parallel with a process pool.
+Each worker opens the file with datapff by itself, so only the file names and the results
+are sent between the processes.
+'''
+import os
+import traceback
+from collections import namedtuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .io import datapff
+
+# result of a file:
+#   fn: pff file name
+#   result: return value of func, or None if there is an error
+#   error: traceback of the error, or None
+fileresult = namedtuple('fileresult', ['fn', 'result', 'error'])
+
+def _run(func, fn, args, kwargs):
+    try:
+        return fileresult(fn, func(datapff(fn), *args, **kwargs), None)
+    except Exception:
+        return fileresult(fn, None, traceback.format_exc())
+
+def map_files(func, files, workers=None, ordered=False, args=(), kwargs=None):
+    '''
+    Description:
+        Call func(datapff(fn), *args, **kwargs) for each file in a process pool.
+        The results are yielded as they finish, and the error of a file doesn't stop the others.
+        At most 2*workers files are submitted at a time, so stopping the iteration early doesn't
+        process the rest of the files.
+    Inputs:
+        -- func(function): a function defined at the top level of a module, so it can be pickled.
+                           It should return a small result, e.g. statistics of the file,
+                           because the result is sent back to the main process.
+        -- files(list): pff file names.
+        -- workers(int): the number of processes.
+                         If it's None, it's the number of CPUs.
+                         Default = None
+        -- ordered(bool): yield the results in the order of the files.
+                          Default = False
+        -- args(tuple): extra positional arguments of func.
+                        Default = ()
+        -- kwargs(dict): extra keyword arguments of func.
+                         Default = None
+    Output:
+        -- result(fileresult): (fn, result, error) of each file.
+    '''
+    if kwargs is None:
+        kwargs = {}
+    if workers is None:
+        workers = os.cpu_count()
+    files = iter(files)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        # only about 2 files per worker are submitted at a time, so the files which are not
+        # submitted yet are never processed if the caller stops iterating
+        pending = deque()
+        def _submit():
+            for fn in files:
+                pending.append(executor.submit(_run, func, fn, args, kwargs))
+                if len(pending) >= 2*workers:
+                    break
+        _submit()
+        while len(pending) != 0:
+            if ordered == True:
+                future = pending.popleft()
+                result = future.result()
+            else:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+                result = future.result()
+            _submit()
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -26,6 +26,15 @@ def get_data_index(qi, bver, loc):
         raise Exception('Please specify the board version: bga or qfp')
     
     phy_loc = pixel_map['pixel_map_maroc2phys'][loc[0]][loc[1]]
+    return get_phys_data_index(qi, phy_loc)
+
+# get the data index of a physical pixel location in the data packets
+#
+def get_phys_data_index(qi, phy_loc):
+    '''
+    qi: quabo index -- [0,1,2,3]
+    phy_loc: physical pixel location [x, y] on the quabo, which starts from 1
+    '''
     i = phy_loc[1] - 1
     j = phy_loc[0] - 1
     if(qi == 0):
@@ -36,7 +45,7 @@ def get_data_index(qi, bver, loc):
         dy = DST_DIM - j - 1
     elif(qi == 2):
         dx = DST_DIM - j - 1
-        dy = SRC_DIM + i
+        dy = i
     elif(qi == 3):
         dx = i
         dy = j
@@ -64,7 +73,7 @@ def get_pixel_loc(qi, bver, index):
         i = SRC_DIM - dx - 1
         j = DST_DIM - dy - 1
     elif(qi == 2):
-        i = SRC - dy
+        i = dy
         j = DST_DIM - dx - 1
     elif(qi == 3):
         i = dx
@@ -40,6 +40,11 @@ setup(name='pypff',
         'matplotlib'
     ],
 
+    # orjson or pysimdjson makes the hk.pff parsing faster
+    extras_require = {
+        'fast': ['orjson']
+    },
+
     package_dir = {'pypff':'pypff'},
     packages = ['pypff'],
     scripts = glob.glob('scripts/*'),